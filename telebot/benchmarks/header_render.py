@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Measure per-message header render cost: legacy per-call rebuild vs precompiled TargetRenderer.
+
+Usage:
+    python3 telebot/benchmarks/header_render.py --count 200000
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from telebot.group_backup.handlers import SourceContext
+from telebot.group_backup.render import HEADER_SEPARATOR, TargetRenderer, parse_focus_users, resolve_timezone
+
+TIMEZONE = 'Asia/Tokyo'
+GLOBAL_FOCUS = [1001, '@alice', '@bob']
+TARGET_INFO = {
+    'target_id': -1002000000000,
+    'target_topic_id': None,
+    'name': 'Backup',
+    'tag': '#backup',
+    'source_focus_users': [2002, '@carol'],
+    'target_focus_users': ['@dave'],
+}
+
+
+class Sender:
+    id = 3003
+    first_name = 'Erin'
+    last_name = 'Doe'
+    username = 'erin'
+
+
+class Chat:
+    id = -1001000000000
+    username = None
+
+
+class Message:
+    id = 42
+    date = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    edit_date = None
+    fwd_from = None
+
+
+def render_legacy(ctx, target_info, global_focus):
+    """The pre-compiled path: resolve timezone, rebuild focus set and concatenate on every message."""
+    resolve_timezone(TIMEZONE)
+    focus = set(global_focus)
+    focus.update(parse_focus_users(target_info.get('source_focus_users', [])))
+    focus.update(parse_focus_users(target_info.get('target_focus_users', [])))
+    sender_name = ctx.sender_name
+    if ctx.sender_id in focus or (ctx.sender_username_lower and ctx.sender_username_lower in focus):
+        sender_name = f"**{sender_name}**"
+    header = f"🧑[{sender_name[0]}] {sender_name} {ctx.sender_username}"
+    if target_info.get('name'):
+        header += f"\n📢 {target_info['name']}"
+    if target_info.get('tag'):
+        header += f" {target_info['tag']}"
+    header += ctx.header_tail
+    header += HEADER_SEPARATOR
+    return header.replace(HEADER_SEPARATOR, "")
+
+
+def render_compiled(ctx, renderer):
+    return renderer.render_header(ctx, separator=False)
+
+
+def bench(label, func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {elapsed / count * 1e6:7.2f} us/header ({count} headers in {elapsed:.2f}s)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Header render microbenchmark')
+    parser.add_argument('--count', type=int, default=100000, help='Headers to render per variant')
+    args = parser.parse_args()
+
+    ctx = SourceContext(Message(), Sender(), Chat(), resolve_timezone(TIMEZONE), TIMEZONE)
+    global_focus = parse_focus_users(GLOBAL_FOCUS)
+    renderer = TargetRenderer(TARGET_INFO, frozenset(global_focus))
+    assert render_legacy(ctx, TARGET_INFO, global_focus) == render_compiled(ctx, renderer)
+
+    legacy = bench("legacy  ", lambda: render_legacy(ctx, TARGET_INFO, global_focus), args.count)
+    compiled = bench("compiled", lambda: render_compiled(ctx, renderer), args.count)
+    print(f"speedup : {legacy / max(compiled, 1e-9):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
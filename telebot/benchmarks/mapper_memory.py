@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compare resident memory of the legacy dict mapping index with MessageMapper's compact index.
+
+Usage:
+    python3 telebot/benchmarks/mapper_memory.py --count 1000000
+"""
+import argparse
+import gc
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from telebot.group_backup.mapper import MappingRecord, MessageMapper
+
+SOURCE_CHATS = [-1001000000000 - i for i in range(8)]
+BACKUP_CHATS = [-1002000000000 - i for i in range(4)]
+
+
+def iter_entries(count):
+    now = int(time.time())
+    for i in range(count):
+        yield (
+            SOURCE_CHATS[i % len(SOURCE_CHATS)],
+            100000 + i,
+            BACKUP_CHATS[i % len(BACKUP_CHATS)],
+            500000 + i,
+            None,
+            now - (i % 86400),
+        )
+
+
+def build_legacy(count):
+    """The pre-compact layout: str keys, list of six-key dicts, tuple-keyed reverse index."""
+    mapping = {}
+    reverse_mapping = {}
+    for sid, smid, tid, tmid, topic, ts in iter_entries(count):
+        entry = {
+            "source_chat_id": sid,
+            "source_msg_id": smid,
+            "backup_chat_id": tid,
+            "backup_msg_id": tmid,
+            "target_topic_id": topic,
+            "timestamp": datetime.fromtimestamp(ts).isoformat(),
+        }
+        mapping.setdefault(f"{sid}_{smid}", []).append(entry)
+        reverse_mapping[(tid, tmid)] = entry
+    return mapping, reverse_mapping
+
+
+def build_compact(count):
+    mapper = MessageMapper(Path(tempfile.mkdtemp()), flush_interval=0)
+    for sid, smid, tid, tmid, topic, ts in iter_entries(count):
+        mapper._index_record(mapper._intern(MappingRecord(sid, smid, tid, tmid, topic, ts)))
+    return mapper
+
+
+def measure(builder, count):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder(count)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mapping index memory benchmark')
+    parser.add_argument('--count', type=int, default=200000, help='Number of mappings')
+    args = parser.parse_args()
+
+    legacy_bytes, legacy_time = measure(build_legacy, args.count)
+    compact_bytes, compact_time = measure(build_compact, args.count)
+
+    print(f"mappings: {args.count}")
+    print(f"legacy : {legacy_bytes / 1024 / 1024:8.1f} MiB ({legacy_bytes / args.count:6.1f} B/mapping) build {legacy_time:.2f}s")
+    print(f"compact: {compact_bytes / 1024 / 1024:8.1f} MiB ({compact_bytes / args.count:6.1f} B/mapping) build {compact_time:.2f}s")
+    print(f"ratio  : {legacy_bytes / max(compact_bytes, 1):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""分块压缩的列式备份归档 (.bka)
+
+文件布局:
+    MAGIC | block 0 | block 1 | ... | index (JSON) | index 偏移 (8 字节, 大端) | MAGIC
+
+每个 block 保存最多 block_records 条记录，按列存储 ({"id": [...], "date": [...], ...}) 后压缩。
+索引记录每个 block 的偏移、长度、条数、ID 范围与日期范围，读取时可只解压命中的 block。
+
+Usage:
+    python3 -m telebot.group_backup.archive convert exports/foo_daily.bak [--codec zstd]
+    python3 -m telebot.group_backup.archive cat foo_daily.bka --min-id 100 --since 2026-01-01
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"TGBKAR01"
+ARCHIVE_SUFFIX = ".bka"
+DEFAULT_BLOCK_RECORDS = 1000
+COLUMNS = ("id", "date", "sender_id", "text", "reply_to")
+
+
+def available_codec(codec: str) -> str:
+    """zstd 需要可选依赖 zstandard，不可用时退回 gzip"""
+    if codec == 'zstd' and zstandard is None:
+        return 'gzip'
+    return codec if codec in ('gzip', 'zstd') else 'gzip'
+
+
+def _compress(codec: str, data: bytes) -> bytes:
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Archive uses zstd but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class ArchiveWriter:
+    """按 ID 升序写入导出记录 (与 .bak 中的 dict 相同)"""
+
+    def __init__(self, path: Path, codec: str = 'gzip', block_records: int = DEFAULT_BLOCK_RECORDS):
+        self.path = Path(path)
+        self.codec = available_codec(codec)
+        self.block_records = max(1, int(block_records))
+        self.tmp_path = self.path.with_name(self.path.name + '.part')
+        self._file = open(self.tmp_path, 'wb')
+        self._file.write(MAGIC)
+        self._pending = []
+        self.index = []
+        self.count = 0
+
+    def write(self, record: dict):
+        self._pending.append(record)
+        self.count += 1
+        if len(self._pending) >= self.block_records:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._pending:
+            return
+        records = self._pending
+        self._pending = []
+        columns = {name: [r.get(name) for r in records] for name in COLUMNS}
+        # 未知字段按行保存，保证与 .bak 记录完全一致
+        extra = [{k: v for k, v in r.items() if k not in COLUMNS} for r in records]
+        if any(extra):
+            columns['_extra'] = extra
+        payload = _compress(self.codec, json.dumps(columns, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        ids = [i for i in columns['id'] if i is not None]
+        dates = [d for d in columns['date'] if d]
+        self.index.append({
+            "offset": self._file.tell(),
+            "length": len(payload),
+            "count": len(records),
+            "min_id": min(ids) if ids else None,
+            "max_id": max(ids) if ids else None,
+            "min_date": min(dates) if dates else None,
+            "max_date": max(dates) if dates else None,
+        })
+        self._file.write(payload)
+
+    def close(self) -> Path:
+        self._flush_block()
+        index_offset = self._file.tell()
+        self._file.write(json.dumps({"codec": self.codec, "count": self.count, "blocks": self.index}).encode('utf-8'))
+        self._file.write(struct.pack('>Q', index_offset))
+        self._file.write(MAGIC)
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class ArchiveReader:
+    """读取 .bka 归档，按 ID / 日期范围只解压命中的 block"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a backup archive")
+            f.seek(-(8 + len(MAGIC)), os.SEEK_END)
+            index_offset = struct.unpack('>Q', f.read(8))[0]
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is truncated")
+            end = f.seek(-(8 + len(MAGIC)), os.SEEK_END)
+            f.seek(index_offset)
+            meta = json.loads(f.read(end - index_offset))
+        self.codec = meta['codec']
+        self.count = meta['count']
+        self.blocks = meta['blocks']
+
+    def __len__(self):
+        return self.count
+
+    def iter_records(self, min_id=None, max_id=None, since: str = None, until: str = None):
+        """产出 min_id <= id <= max_id 且 since <= date < until 的记录 (日期为 ISO 字符串，按字典序比较)"""
+        with open(self.path, 'rb') as f:
+            for block in self.blocks:
+                if min_id is not None and block['max_id'] is not None and block['max_id'] < min_id:
+                    continue
+                if max_id is not None and block['min_id'] is not None and block['min_id'] > max_id:
+                    continue
+                if since and block['max_date'] and block['max_date'] < since:
+                    continue
+                if until and block['min_date'] and block['min_date'] >= until:
+                    continue
+                f.seek(block['offset'])
+                columns = json.loads(_decompress(self.codec, f.read(block['length'])))
+                extra = columns.get('_extra')
+                for i in range(block['count']):
+                    record = {name: columns[name][i] for name in COLUMNS}
+                    if extra and extra[i]:
+                        record.update(extra[i])
+                    msg_id = record.get('id')
+                    if min_id is not None and (msg_id is None or msg_id < min_id):
+                        continue
+                    if max_id is not None and (msg_id is None or msg_id > max_id):
+                        continue
+                    date = record.get('date') or ''
+                    if since and date < since:
+                        continue
+                    if until and date >= until:
+                        continue
+                    yield record
+
+
+def archive_path_for(path: Path) -> Path:
+    """x.bak / x.bak.gz -> x.bka"""
+    name = path.name
+    for suffix in ('.gz', '.bak'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return path.with_name(name + ARCHIVE_SUFFIX)
+
+
+def convert_export(src: Path, dst: Path = None, codec: str = 'gzip', block_records: int = DEFAULT_BLOCK_RECORDS) -> Path:
+    """将 .bak / .bak.gz JSONL 导出转换为 .bka 归档"""
+    from .export import iter_export_records
+
+    writer = ArchiveWriter(dst or archive_path_for(Path(src)), codec=codec, block_records=block_records)
+    try:
+        for record in iter_export_records(Path(src)):
+            writer.write(record)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backup archive (.bka) tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    convert = sub.add_parser('convert', help='Convert .bak/.bak.gz exports to .bka')
+    convert.add_argument('files', nargs='+', type=Path)
+    convert.add_argument('--codec', default='gzip', choices=('gzip', 'zstd'))
+    convert.add_argument('--block-records', type=int, default=DEFAULT_BLOCK_RECORDS)
+
+    cat = sub.add_parser('cat', help='Print records of a .bka archive as JSONL')
+    cat.add_argument('file', type=Path)
+    cat.add_argument('--min-id', type=int)
+    cat.add_argument('--max-id', type=int)
+    cat.add_argument('--since', help='ISO date/time, inclusive')
+    cat.add_argument('--until', help='ISO date/time, exclusive')
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        for src in args.files:
+            dst = convert_export(src, codec=args.codec, block_records=args.block_records)
+            print(f"{src} ({src.stat().st_size} B) -> {dst} ({dst.stat().st_size} B)")
+    else:
+        reader = ArchiveReader(args.file)
+        for record in reader.iter_records(args.min_id, args.max_id, args.since, args.until):
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class BackupTextCache:
+    """备份消息文本缓存 (LRU)，编辑/撤回时无需再从 Telegram 读取自己发出的消息"""
+
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max(0, int(max_size))
+        self._texts = OrderedDict() # (backup_chat_id, backup_msg_id) -> text
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id, msg_id):
+        """返回缓存的文本，未命中返回 None (空字符串是有效文本)"""
+        key = (chat_id, msg_id)
+        text = self._texts.get(key)
+        if text is None:
+            self.misses += 1
+            return None
+        self._texts.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, chat_id, msg_id, text):
+        if not self.max_size or msg_id is None:
+            return
+        key = (chat_id, msg_id)
+        self._texts[key] = text or ""
+        self._texts.move_to_end(key)
+        while len(self._texts) > self.max_size:
+            self._texts.popitem(last=False)
+
+    def put_message(self, chat_id, message):
+        """记录刚发送/读取到的备份消息"""
+        if message is not None:
+            self.put(chat_id, message.id, message.text)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._texts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
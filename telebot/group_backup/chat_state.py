@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+
+class ChatStateStore(dict):
+    """备份目标的头部分组状态 {(target_id, topic_id): {last_sender_id, last_fwd_sig}}
+
+    定期快照到 JSON 文件并在退出时保存，重启后不会在每个目标重复发送完整头部。
+    """
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = path
+        self.dirty = False
+        self.logger = logging.getLogger(__name__)
+        self._load()
+
+    @staticmethod
+    def encode_key(queue_key) -> str:
+        target_id, topic_id = queue_key
+        return f"{target_id}:{topic_id or 0}"
+
+    @staticmethod
+    def decode_key(key: str):
+        target_id, topic_id = key.split(':')
+        return int(target_id), (int(topic_id) or None)
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for key, state in data.items():
+                super().__setitem__(self.decode_key(key), state)
+            self.logger.info(f"Loaded {len(self)} chat states")
+        except Exception as e:
+            self.logger.error(f"Failed to load chat states: {e}")
+
+    def __setitem__(self, key, value):
+        if self.get(key) != value:
+            self.dirty = True
+        super().__setitem__(key, value)
+
+    def snapshot(self) -> dict | None:
+        """取变化后的快照 (须在事件循环线程调用)，无变化时返回 None"""
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return {self.encode_key(key): state for key, state in self.items()}
+
+    def write(self, data: dict):
+        """原子写入快照 (可在线程池中执行)"""
+        tmp_path = self.path.with_suffix('.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.dirty = True
+            self.logger.error(f"Failed to save chat states: {e}")
+
+    def save(self):
+        """有变化时同步保存 (用于退出时)"""
+        data = self.snapshot()
+        if data is not None:
+            self.write(data)
@@ -1,18 +1,29 @@
 import logging
 import asyncio
 import os
+import signal
 import sys
+import time
 from pathlib import Path
 from datetime import datetime, timedelta
 import pytz
+import itertools
 import json
 from telethon import TelegramClient, events, utils
+from telethon.errors import FloodWaitError
 from telethon.tl.types import UpdateMessageReactions
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 
 from .mapper import MessageMapper
 from .handlers import MessageHandler
 from .summarizer import GroupSummarizer
+from .entity_cache import EntityCache
+from .journal import TaskJournal
+from .chat_state import ChatStateStore
+from .archive import convert_export
+from .export import ExportState, ExportWriter, find_daily_exports, merge_export_records, meta_path_for
+from .rate_limiter import SendScheduler, PRIORITY_BULK
 
 class GroupBackupClient:
     """群消息备份客户端"""
@@ -23,18 +34,50 @@ class GroupBackupClient:
         self.api_hash = api_hash
         self.config = config
         self.logger = logger
-        self.mapper = MessageMapper(data_dir)
+        settings = config.get('settings', {})
+        self.mapper = MessageMapper(
+            data_dir,
+            backend=settings.get('mapping_backend', 'log'),
+            flush_interval=settings.get('mapping_flush_interval', 1.0),
+            flush_batch_size=settings.get('mapping_flush_batch_size', 200),
+            lazy=True,
+        )
         self.session_file = data_dir / f"{session_name}.session"
         self.client = None
         
         # source_id -> [ {target_id, name, tag} ]
         self.source_map = {}
-        # target_id -> {last_sender_id}
-        self.chat_states = {}
+        # (target_id, topic_id) -> {last_sender_id, last_fwd_sig}, 持久化到 chat_states.json
+        self.chat_states = ChatStateStore(data_dir / "chat_states.json")
+        
+        # 转发/总结/导出共用的实体缓存
+        self.entity_cache = EntityCache(
+            None,
+            max_size=settings.get('entity_cache_size', 2048),
+            ttl=settings.get('entity_cache_ttl', 3600),
+        )
+        
+        # 持久化转发任务日志 (重启/崩溃后重放)
+        self.journal = TaskJournal(data_dir / "forward_queue.db") if settings.get('durable_queue', True) else None
+        
+        # 所有对外发送共用的限流调度 (全局 + 单会话令牌桶)
+        self.scheduler = SendScheduler(
+            global_rate=settings.get('send_rate_global', 20),
+            global_burst=settings.get('send_burst_global', 20),
+            chat_rate=settings.get('send_rate_per_chat', 1),
+            chat_burst=settings.get('send_burst_per_chat', 3),
+            max_retries=settings.get('flood_wait_max_retries', 3),
+        )
         
         self._parse_config()
-        self.handler = MessageHandler(None, config, self.mapper, self.chat_states) # Client not set yet
-        self.summarizer = GroupSummarizer(None, config, self.mapper, logger)
+        self.handler = MessageHandler(None, config, self.mapper, self.chat_states, self.entity_cache,
+                                      self.journal, self.scheduler) # Client not set yet
+        self.handler.compile_renderers(self.source_map)
+        self.summarizer = GroupSummarizer(None, config, self.mapper, logger, self.entity_cache, self.scheduler)
+        # 每个导出任务/目标的 high-water mark，增量导出并在停机后补齐
+        self.export_state = ExportState(data_dir / "export_state.json")
+        # 每日导出完成后排队等待总结，AI 调用不阻塞下一个导出
+        self.summary_queue = asyncio.Queue()
 
     def _parse_entity_id(self, id_val):
         """Parses ID into (chat_id, topic_id)"""
@@ -125,16 +168,21 @@ class GroupBackupClient:
         if schedule_config.get('daily_time'):
             daily_time = schedule_config.get('daily_time', '04:00')
             h, m = map(int, daily_time.split(':'))
-            scheduler.add_job(self.run_daily_backup, 'cron', hour=h, minute=m, timezone=timezone)
+            trigger = CronTrigger(hour=h, minute=m, timezone=timezone)
+            # 事件循环繁忙等导致延迟触发时仍执行一次 (停机期间错过的由 _schedule_catch_up 补跑)
+            scheduler.add_job(self.run_daily_backup, trigger, misfire_grace_time=12 * 3600, coalesce=True)
             self.logger.info(f"已计划每日备份: {daily_time}")
+            self._schedule_catch_up(scheduler, "daily", trigger, self.run_daily_backup)
 
         # Weekly Backup
         if schedule_config.get('weekly_time'):
             weekly_time = schedule_config.get('weekly_time', '04:00')
             wd = schedule_config.get('weekly_day', 'mon')
             wh, wm = map(int, weekly_time.split(':'))
-            scheduler.add_job(self.run_weekly_backup, 'cron', day_of_week=wd, hour=wh, minute=wm, timezone=timezone)
+            trigger = CronTrigger(day_of_week=wd, hour=wh, minute=wm, timezone=timezone)
+            scheduler.add_job(self.run_weekly_backup, trigger, misfire_grace_time=12 * 3600, coalesce=True)
             self.logger.info(f"已计划每周备份: {wd} {weekly_time}")
+            self._schedule_catch_up(scheduler, "weekly", trigger, self.run_weekly_backup)
             
         # Cleanup Job (Daily at 03:00)
         retention_days = settings.get('mapping_retention_days', 90)
@@ -145,28 +193,48 @@ class GroupBackupClient:
             )
             self.logger.info(f"已计划每日清理过期映射 (保留{retention_days}天)")
 
+        # Header grouping state snapshot
+        scheduler.add_job(self._snapshot_chat_states, 'interval',
+                          seconds=max(1, settings.get('chat_state_snapshot_interval', 30)))
+
+        # Runtime Stats (Hourly)
+        scheduler.add_job(self.log_runtime_stats, 'interval', hours=1)
+
         scheduler.start()
 
-    async def _export_messages(self, chat_id, start_time, export_dir, suffix="", topic_id=None):
-        messages = []
-        try:
-            async for msg in self.client.iter_messages(chat_id, offset_date=start_time, reverse=True, reply_to=topic_id):
-                if not msg.text and not msg.media: continue
-                messages.append({
-                    "id": msg.id,
-                    "date": msg.date.isoformat(),
-                    "sender_id": msg.sender_id,
-                    "text": msg.text,
-                    "reply_to": msg.reply_to_msg_id
-                })
-        except Exception as e:
-            self.logger.error(f"Export fetch failed for {chat_id} (topic {topic_id}): {e}")
-            return None
+    def _schedule_catch_up(self, scheduler, job, trigger, func):
+        """APScheduler 任务只在内存中，停机期间错过的触发不会重放；
+        上次完成之后本应有过一次触发时，启动后立即补跑一次 (high-water mark 保证只导出缺口)"""
+        last_run = self.export_state.last_run(job)
+        if last_run is None:
+            return
+        missed = trigger.get_next_fire_time(None, datetime.fromtimestamp(last_run, pytz.utc))
+        if missed is not None and missed <= datetime.now(pytz.utc):
+            self.logger.info(f"补跑停机期间错过的{job}备份 (应于 {missed} 触发)")
+            scheduler.add_job(func)
+
+    async def _snapshot_chat_states(self):
+        """在事件循环中取快照 (状态只在循环内修改)，文件写入放到线程池"""
+        data = self.chat_states.snapshot()
+        if data is not None:
+            await asyncio.to_thread(self.chat_states.write, data)
 
-        if not messages: return None
+    async def log_runtime_stats(self):
+        """定期输出运行时统计 (协程: 在事件循环中读取各统计字典，避免与循环并发修改)"""
+        self.logger.info(f"Entity cache stats: {self.entity_cache.stats()}")
+        self.logger.info(f"Album stats: {self.handler.album_stats()}")
+        self.logger.info(f"Edit stats: {self.handler.edit_stats()}")
+        self.logger.info(f"Backup text cache stats: {self.handler.backup_texts.stats()}")
+        self.logger.info(f"Queue stats: {self.handler.queue_stats()}")
+        self.logger.info(f"Send scheduler stats: {self.scheduler.stats()}")
+        self.logger.info(f"Pending summaries: {self.summary_queue.qsize()}")
+        if self.summarizer.cache:
+            self.logger.info(f"Summary cache stats: {self.summarizer.cache.stats()}")
 
+    async def _export_path(self, chat_id, export_dir, suffix, topic_id):
+        """导出文件路径: 标题_[话题_]日期[-N]后缀.bak"""
         try:
-            entity = await self.client.get_entity(chat_id)
+            entity = await self.entity_cache.get_entity(chat_id)
             chat_title = getattr(entity, 'title', str(chat_id))
         except:
             chat_title = str(chat_id)
@@ -174,32 +242,179 @@ class GroupBackupClient:
         safe_title = "".join([c for c in chat_title if c.isalnum() or c in (' ', '-', '_')]).strip()
         date_str = self._now_in_config_timezone().strftime('%Y-%m-%d')
         
-        if topic_id:
-            filename = f"{safe_title}_{topic_id}_{date_str}{suffix}.bak"
-        else:
-            filename = f"{safe_title}_{date_str}{suffix}.bak"
-        
-        export_dir.mkdir(parents=True, exist_ok=True)
-        file_path = export_dir / filename
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
-            for m in messages:
-                f.write(json.dumps(m, ensure_ascii=False) + '\n')
+        # 同一天再次导出 (补跑) 时只含新消息，不能覆盖已有文件
+        run = 1
+        while True:
+            run_str = date_str if run == 1 else f"{date_str}-{run}"
+            if topic_id:
+                filename = f"{safe_title}_{topic_id}_{run_str}{suffix}.bak"
+            else:
+                filename = f"{safe_title}_{run_str}{suffix}.bak"
+            if not (export_dir / filename).exists() and not (export_dir / f"{filename}.gz").exists():
+                return export_dir / filename
+            run += 1
+
+    def _new_export_writer(self, path):
+        compress = self.config.get('settings', {}).get('backup_schedule', {}).get('compress_exports', False)
+        return ExportWriter(path, compress=compress)
+
+    def _export_record(self, msg):
+        if not msg.text and not msg.media:
+            return None
+        return {
+            "id": msg.id,
+            "date": msg.date.isoformat(),
+            "sender_id": msg.sender_id,
+            "text": msg.text,
+            "reply_to": msg.reply_to_msg_id
+        }
+
+    async def _iter_history(self, chat_id, topic_id, min_id=0, max_id=0, offset_date=None):
+        """按 ID 升序拉取 (min_id, max_id) 区间的历史消息；无 min_id 时从 offset_date 开始"""
+        wait_time = self.config.get('settings', {}).get('backup_schedule', {}).get('export_wait_time')
+        while True:
+            position = {'min_id': min_id} if min_id else {'offset_date': offset_date}
+            if max_id:
+                position['max_id'] = max_id
+            try:
+                async for msg in self.client.iter_messages(chat_id, reverse=True, reply_to=topic_id,
+                                                           wait_time=wait_time, **position):
+                    min_id = msg.id
+                    yield msg
+                return
+            except FloodWaitError as e:
+                # 等待后从最后一条消息继续拉取
+                self.logger.warning(f"Export of {chat_id} hit FloodWait, resuming after {e.seconds}s")
+                await asyncio.sleep(e.seconds)
+
+    async def _fetch_into(self, writer, chat_id, topic_id, min_id=0, max_id=0, offset_date=None):
+        """拉取区间内消息写入 writer，返回看到的最大消息 ID"""
+        last_id = min_id
+        async for msg in self._iter_history(chat_id, topic_id, min_id, max_id, offset_date):
+            last_id = max(last_id, msg.id)
+            record = self._export_record(msg)
+            if record:
+                writer.write(record)
+        return last_id
+
+    def _finish_export(self, writer, chat_id, topic_id):
+        """提交导出文件并写 .meta；没有消息时丢弃并返回 None"""
+        if not writer.count:
+            writer.abort()
+            return None
+
+        file_path = writer.commit()
+        self.logger.info(
+            f"Exported {writer.count} messages from {chat_id} (topic {topic_id}) to {file_path.name} "
+            f"({writer.rate:.0f} msg/s)"
+        )
         
         # Write metadata
         try:
-            meta_path = file_path.with_suffix('.bak.meta')
+            meta_path = meta_path_for(file_path)
             with open(meta_path, 'w', encoding='utf-8') as f:
                 json.dump({
                     "target_id": chat_id, 
                     "topic_id": topic_id,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": datetime.now().isoformat(),
+                    "first_id": writer.first_id,
+                    "last_id": writer.last_id
                 }, f)
         except Exception as e:
-            self.logger.error(f"Failed to write metadata for {filename}: {e}")
+            self.logger.error(f"Failed to write metadata for {file_path.name}: {e}")
             
         return file_path
 
+    async def _export_messages(self, chat_id, start_time, export_dir, suffix="", topic_id=None, since_id=None):
+        """从 Telegram 流式导出消息，返回 (文件路径或 None, 看到的最大消息 ID)
+
+        指定 since_id (high-water mark) 时只导出其后的消息，否则从 start_time 开始。
+        """
+        # 边拉取边写入，内存占用与消息数量无关
+        writer = self._new_export_writer(await self._export_path(chat_id, export_dir, suffix, topic_id))
+        try:
+            last_id = await self._fetch_into(writer, chat_id, topic_id, min_id=since_id or 0, offset_date=start_time)
+        except Exception as e:
+            writer.abort()
+            self.logger.error(f"Export fetch failed for {chat_id} (topic {topic_id}): {e}")
+            return None, since_id
+        return self._finish_export(writer, chat_id, topic_id), last_id
+
+    async def _compact_weekly(self, chat_id, start_time, daily_dir, export_dir, topic_id=None, since_id=None):
+        """由本地每日导出文件合并去重生成每周导出，只从 Telegram 补拉缺口
+
+        缺口: 每日文件覆盖范围之前 (since_id/start_time 到第一条) 和之后 (最后一条之后) 的消息。
+        返回值同 _export_messages。
+        """
+        # 只打开可能含有 high-water mark / 时间窗口之后记录的每日文件
+        daily_files = find_daily_exports(daily_dir, chat_id, topic_id, min_id=since_id or 0, since=start_time)
+        records = merge_export_records(daily_files, min_id=since_id or 0,
+                                       since=None if since_id else start_time)
+        first = next(records, None)
+
+        writer = self._new_export_writer(await self._export_path(chat_id, export_dir, "_weekly", topic_id))
+        try:
+            last_id = since_id or 0
+            if first is None:
+                # 没有可用的每日文件，退回完整拉取
+                last_id = await self._fetch_into(writer, chat_id, topic_id, min_id=last_id, offset_date=start_time)
+            else:
+                if not last_id or first['id'] > last_id + 1:
+                    await self._fetch_into(writer, chat_id, topic_id, min_id=last_id, max_id=first['id'],
+                                           offset_date=start_time)
+                local = 0
+                for record in itertools.chain((first,), records):
+                    writer.write(record)
+                    last_id = record['id']
+                    local += 1
+                last_id = await self._fetch_into(writer, chat_id, topic_id, min_id=last_id)
+                fetched = writer.count - local
+                self.logger.info(
+                    f"Weekly export of {chat_id} (topic {topic_id}): {local} messages from "
+                    f"{len(daily_files)} daily files, {fetched} fetched"
+                )
+        except Exception as e:
+            writer.abort()
+            self.logger.error(f"Weekly compaction failed for {chat_id} (topic {topic_id}): {e}")
+            return None, since_id
+        return self._finish_export(writer, chat_id, topic_id), last_id
+
+    def _backup_targets(self):
+        """所有唯一的备份群 (TargetID, TopicID)"""
+        unique_targets = set()
+        for targets in self.source_map.values():
+            for target in targets:
+                unique_targets.add((target['target_id'], target['target_topic_id']))
+        return unique_targets
+
+    async def _run_exports(self, export_one):
+        """以有限并发对每个备份目标执行 export_one(target_id, topic_id)"""
+        concurrency = self.config.get('settings', {}).get('backup_schedule', {}).get('export_concurrency', 3)
+        semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+        started_at = time.perf_counter()
+
+        async def run(target_id, topic_id):
+            async with semaphore:
+                try:
+                    await export_one(target_id, topic_id)
+                except Exception as e:
+                    self.logger.error(f"Export of {target_id} (topic {topic_id}) failed: {e}", exc_info=True)
+
+        targets = self._backup_targets()
+        await asyncio.gather(*(run(target_id, topic_id) for target_id, topic_id in targets))
+        self.logger.info(f"Exported {len(targets)} targets in {time.perf_counter() - started_at:.1f}s")
+
+    async def _summary_worker(self):
+        """按顺序处理排队的总结任务"""
+        while True:
+            path, target_id = await self.summary_queue.get()
+            try:
+                await self.summarizer.run_process(path, target_id)
+            except Exception as e:
+                self.logger.error(f"Summary of {path} failed: {e}", exc_info=True)
+            finally:
+                self.summary_queue.task_done()
+
     async def run_daily_backup(self):
         """每日备份 (从备份群导出)"""
         try:
@@ -208,18 +423,18 @@ class GroupBackupClient:
             export_dir = Path(schedule.get('local_export_dir', './data/exports'))
             start_time = datetime.now(pytz.utc) - timedelta(hours=24)
             
-            # 获取所有唯一的备份群ID (TargetID, TopicID)
-            unique_targets = set()
-            for targets in self.source_map.values():
-                for target in targets:
-                    unique_targets.add((target['target_id'], target['target_topic_id']))
-            
-            for target_id, topic_id in unique_targets:
-                path = await self._export_messages(target_id, start_time, export_dir, suffix="_daily", topic_id=topic_id)
+            async def export_one(target_id, topic_id):
+                path, last_id = await self._export_messages(
+                    target_id, start_time, export_dir, suffix="_daily", topic_id=topic_id,
+                    since_id=self.export_state.get("daily", target_id, topic_id),
+                )
+                self.export_state.advance("daily", target_id, topic_id, last_id)
                 # Trigger Summary
                 if path and self.summarizer:
-                    await self.summarizer.run_process(path, target_id)
+                    self.summary_queue.put_nowait((path, target_id))
 
+            await self._run_exports(export_one)
+            self.export_state.mark_run("daily")
         except Exception as e:
             self.logger.error(f"每日备份异常: {e}")
 
@@ -228,40 +443,75 @@ class GroupBackupClient:
         try:
             self.logger.info("开始每周备份...")
             export_dir = Path("./data/temp_weekly")
+            schedule = self.config.get('settings', {}).get('backup_schedule', {})
+            daily_dir = Path(schedule.get('local_export_dir', './data/exports'))
             start_time = datetime.now(pytz.utc) - timedelta(days=7)
             
-            # 获取所有唯一的备份群ID (TargetID, TopicID)
-            unique_targets = set()
-            for targets in self.source_map.values():
-                for target in targets:
-                    unique_targets.add((target['target_id'], target['target_topic_id']))
-            
-            for target_id, topic_id in unique_targets:
-                path = await self._export_messages(target_id, start_time, export_dir, suffix="_weekly", topic_id=topic_id)
-                if path:
+            async def export_one(target_id, topic_id):
+                since_id = self.export_state.get("weekly", target_id, topic_id)
+                if schedule.get('weekly_from_daily', True):
+                    path, last_id = await self._compact_weekly(target_id, start_time, daily_dir, export_dir,
+                                                               topic_id=topic_id, since_id=since_id)
+                else:
+                    path, last_id = await self._export_messages(target_id, start_time, export_dir, suffix="_weekly",
+                                                                topic_id=topic_id, since_id=since_id)
+                if not path:
+                    self.export_state.advance("weekly", target_id, topic_id, last_id)
+                else:
                     caption = f"#备份 (Weekly) {datetime.now().strftime('%Y-%m-%d')}"
                     if topic_id:
                         caption += f" Topic:{topic_id}"
                     
+                    upload_path = path
                     try:
-                        await self.client.send_file(target_id, path, caption=caption, reply_to=topic_id)
+                        if schedule.get('weekly_format', 'jsonl') == 'archive':
+                            # 分块压缩归档，减少上传字节
+                            upload_path = await asyncio.to_thread(
+                                convert_export, path, codec=schedule.get('archive_codec', 'gzip'))
+                        await self.scheduler.call(target_id, PRIORITY_BULK, self.client.send_file,
+                                                  target_id, upload_path, caption=caption, reply_to=topic_id)
+                        # 上传成功后才推进，失败时下次重新包含这些消息
+                        self.export_state.advance("weekly", target_id, topic_id, last_id)
                     except Exception as e:
                         self.logger.error(f"Failed to upload to {target_id} (topic {topic_id}): {e}")
                         
-                    if os.path.exists(path):
-                        os.remove(path)
+                    for leftover in {path, meta_path_for(path), upload_path}:
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+
+            await self._run_exports(export_one)
+            self.export_state.mark_run("weekly")
         except Exception as e:
             self.logger.error(f"每周备份异常: {e}")
 
     async def start(self):
         self.logger.info("Starting backup bot (Refactored)...")
-        self.client = TelegramClient(str(self.session_file), self.api_id, self.api_hash)
+        started_at = time.perf_counter()
+        # 旧版映射迁移会重写分段文件，须在开始写入新映射前完成 (仅首次启动耗时)
+        await asyncio.to_thread(self.mapper.prepare)
+        # 映射在后台加载，客户端无需等待即可开始接收事件
+        self.mapper.start_loading()
+        # 短 FloodWait 仍由 Telethon 内部等待 (覆盖读取发送者/实体、重放取消息等未经调度的调用)，
+        # 超过阈值抛出的长 FloodWait 由 SendScheduler 按会话暂停后重新排队
+        self.client = TelegramClient(
+            str(self.session_file), self.api_id, self.api_hash,
+            flood_sleep_threshold=self.config.get('settings', {}).get('flood_sleep_threshold', 60),
+        )
         self.handler.client = self.client # Inject client into handler
         self.summarizer.client = self.client # Inject client into summarizer
+        self.entity_cache.client = self.client
         
         await self.client.start()
+        self._install_signal_handlers()
+        # Replay forward tasks left over from the previous run before new events arrive
+        await self.handler.restore_pending()
         self.start_scheduler()
         
+        # Pre-warm entity cache with configured source groups (in background)
+        asyncio.create_task(self.entity_cache.warm(list(self.source_map.keys())))
+        
+        asyncio.create_task(self._summary_worker())
+        
         # Trigger async backfill check
         asyncio.create_task(self.summarizer.run_batch_backfill())
         
@@ -335,7 +585,25 @@ class GroupBackupClient:
                 mock_event = ReactionEvent(event.msg_id, matched_id, reaction_to_send)
                 await self.handler.handle_reaction(mock_event, targets)
             
-        await self.client.run_until_disconnected()
+        self.logger.info(
+            f"Client ready in {time.perf_counter() - started_at:.2f}s "
+            f"(message mapping {'loaded' if self.mapper.loaded else 'still loading in background'})"
+        )
+        try:
+            await self.client.run_until_disconnected()
+        finally:
+            self.chat_states.save()
+            self.mapper.close()
+            if self.journal:
+                self.journal.close()
+
+    def _install_signal_handlers(self):
+        """SIGTERM (systemd stop) 时正常断开，以便落盘缓冲数据"""
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.client.disconnect()))
+        except (NotImplementedError, RuntimeError):
+            pass
 
     def run(self):
         asyncio.run(self.start())
@@ -0,0 +1,102 @@
+import logging
+import time
+from collections import OrderedDict
+
+from telethon import utils
+
+
+class EntityCache:
+    """用户/会话实体缓存 (LRU + TTL)，供转发、总结、导出共用，减少 get_entity 请求"""
+
+    def __init__(self, client=None, max_size: int = 2048, ttl: float = 3600):
+        self.client = client
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        self.logger = logging.getLogger(__name__)
+        self._entries = OrderedDict() # peer_id -> (expires_at, entity)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, peer_id):
+        """同步查询缓存，未命中或已过期返回 None"""
+        if peer_id is None:
+            return None
+        item = self._entries.get(peer_id)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, entity = item
+        if expires_at < time.monotonic():
+            del self._entries[peer_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(peer_id)
+        self.hits += 1
+        return entity
+
+    def put(self, entity, *peer_ids):
+        """缓存实体；除实体自身的 peer id 外，还可附加请求时使用的 id"""
+        if entity is None:
+            return
+        keys = set(peer_ids)
+        try:
+            keys.add(utils.get_peer_id(entity))
+        except Exception:
+            pass
+        expires_at = time.monotonic() + self.ttl
+        for key in keys:
+            if key is None:
+                continue
+            self._entries[key] = (expires_at, entity)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_entity(self, peer_id):
+        entity = self.get(peer_id)
+        if entity is None:
+            entity = await self.client.get_entity(peer_id)
+            self.put(entity, peer_id)
+        return entity
+
+    async def get_entities(self, peer_ids) -> list:
+        """批量获取实体，未命中部分合并为一次 get_entity 请求"""
+        found = []
+        missing = []
+        for peer_id in peer_ids:
+            entity = self.get(peer_id)
+            if entity is None:
+                missing.append(peer_id)
+            else:
+                found.append(entity)
+
+        if missing:
+            fetched = await self.client.get_entity(missing)
+            if not isinstance(fetched, list):
+                fetched = [fetched]
+            for peer_id, entity in zip(missing, fetched):
+                self.put(entity, peer_id)
+            found.extend(fetched)
+        return found
+
+    async def warm(self, peer_ids):
+        """预热缓存 (逐个获取，单个失败不影响其它)"""
+        warmed = 0
+        for peer_id in peer_ids:
+            if self.get(peer_id) is not None:
+                continue
+            try:
+                self.put(await self.client.get_entity(peer_id), peer_id)
+                warmed += 1
+            except Exception as e:
+                self.logger.warning(f"Entity cache warm-up failed for {peer_id}: {e}")
+        self.logger.info(f"Entity cache warmed with {warmed} entities")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
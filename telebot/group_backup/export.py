@@ -0,0 +1,184 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+# 写入缓冲区大小，导出文件按块落盘而不是逐行写
+EXPORT_BUFFER_SIZE = 1 << 20
+
+
+def open_export(path: Path, mode: str = 'r', compressed: bool = None):
+    """以文本模式打开导出文件，.gz 结尾 (或 compressed=True) 时透明压缩/解压"""
+    if compressed is None:
+        compressed = str(path).endswith('.gz')
+    if compressed:
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=6)
+    return open(path, mode, encoding='utf-8', buffering=EXPORT_BUFFER_SIZE)
+
+
+def iter_export_records(path: Path):
+    """逐行读取导出文件 (JSONL)，跳过损坏的行"""
+    with open_export(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.getLogger(__name__).warning(f"Skipping corrupt line in {path}")
+
+
+def meta_path_for(path: Path) -> Path:
+    """x.bak / x.bak.gz -> x.bak.meta"""
+    name = path.name[:-3] if path.name.endswith('.gz') else path.name
+    return path.with_name(name + '.meta')
+
+
+def find_daily_exports(export_dir: Path, target_id, topic_id, min_id: int = 0, since: datetime = None) -> list:
+    """按 .meta 找出属于某个备份目标/话题的每日导出文件
+
+    跳过不可能含有所需记录的旧文件: .meta 记录了 last_id 时要求 last_id > min_id，
+    否则 (旧版 .meta 或未指定 min_id) 要求导出完成时间不早于 since。
+    被跳过区间的消息由调用方从 Telegram 补拉，结果不受影响。
+    """
+    found = []
+    for path in list(export_dir.glob("*_daily.bak")) + list(export_dir.glob("*_daily.bak.gz")):
+        try:
+            with open(meta_path_for(path), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get('target_id') != target_id or meta.get('topic_id') != topic_id:
+            continue
+        if min_id and meta.get('last_id') is not None:
+            if meta['last_id'] <= min_id:
+                continue
+        elif since is not None and _meta_time(meta) < since:
+            continue
+        found.append(path)
+    return found
+
+
+def _meta_time(meta: dict) -> datetime:
+    """导出完成时间 (旧版 .meta 为本地时间的 naive ISO 字符串)；无法解析时视为最新"""
+    try:
+        return datetime.fromisoformat(meta['timestamp']).astimezone()
+    except (KeyError, TypeError, ValueError):
+        return datetime.now().astimezone()
+
+
+def merge_export_records(paths, min_id: int = 0, since: datetime = None):
+    """多路归并若干导出文件 (各自按 ID 升序)，去重后按 ID 升序逐条产出
+
+    只保留 id > min_id 且 (指定 since 时) 日期不早于 since 的记录。
+    """
+    def records(path):
+        for record in iter_export_records(path):
+            if record.get('id', 0) <= min_id:
+                continue
+            if since is not None:
+                try:
+                    if datetime.fromisoformat(record['date']) < since:
+                        continue
+                except (KeyError, TypeError, ValueError):
+                    continue
+            yield record
+
+    last_id = None
+    for record in heapq.merge(*(records(p) for p in paths), key=lambda r: r['id']):
+        if record['id'] != last_id:
+            last_id = record['id']
+            yield record
+
+
+class ExportWriter:
+    """流式 JSONL 导出: 写入临时 .part 文件，完成后原子改名；内存占用与消息数量无关"""
+
+    def __init__(self, path: Path, compress: bool = False):
+        self.path = path.with_name(path.name + '.gz') if compress and not path.name.endswith('.gz') else path
+        self.tmp_path = self.path.with_name(self.path.name + '.part')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open_export(self.tmp_path, 'w', compressed=self.path.name.endswith('.gz'))
+        self.count = 0
+        self.first_id = None
+        self.last_id = None
+        self.started_at = time.perf_counter()
+
+    def write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.count += 1
+        if self.first_id is None:
+            self.first_id = record.get('id')
+        self.last_id = record.get('id')
+
+    def commit(self) -> Path:
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    @property
+    def rate(self) -> float:
+        """导出速度 (条/秒)"""
+        elapsed = time.perf_counter() - self.started_at
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+
+class ExportState:
+    """每个导出任务/目标/话题已导出的最大消息 ID (high-water mark)，下次从该 ID 之后继续导出
+
+    同时记录每个任务上次完成的时间，用于启动时补跑停机期间错过的定时任务。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self._marks = {}
+        if path.exists():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._marks = json.load(f)
+            except Exception as e:
+                self.logger.error(f"Failed to load export state: {e}")
+
+    @staticmethod
+    def _key(job, target_id, topic_id) -> str:
+        return f"{job}:{target_id}:{topic_id or 0}"
+
+    def get(self, job, target_id, topic_id):
+        return self._marks.get(self._key(job, target_id, topic_id))
+
+    def advance(self, job, target_id, topic_id, last_id):
+        """只向前推进并立即保存"""
+        key = self._key(job, target_id, topic_id)
+        if not last_id or last_id <= self._marks.get(key, 0):
+            return
+        self._marks[key] = last_id
+        self._save()
+
+    def last_run(self, job):
+        """任务上次完成的时间 (epoch 秒)，没有记录时为 None"""
+        return self._marks.get(f"run:{job}")
+
+    def mark_run(self, job):
+        self._marks[f"run:{job}"] = time.time()
+        self._save()
+
+    def _save(self):
+        tmp_path = self.path.with_suffix('.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._marks, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.error(f"Failed to save export state: {e}")
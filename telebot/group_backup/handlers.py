@@ -1,34 +1,138 @@
 import logging
-import pytz
 import asyncio
+import time
 from datetime import datetime
+from telethon.errors import FloodWaitError, ServerError, TimedOutError
 from telethon.tl.types import MessageService, MessageMediaWebPage, Message, UpdateMessageReactions
 from telethon.tl.functions.messages import SendReactionRequest
 
+from .backup_text import BackupTextCache
+from .entity_cache import EntityCache
+from .render import HEADER_SEPARATOR, TargetRenderer, parse_focus_users, resolve_timezone
+from .rate_limiter import SendScheduler, PRIORITY_NEW, PRIORITY_EDIT, PRIORITY_REACTION
+from .stats import LatencyHistogram
+from .tasks import decode_task, encode_task
+
+# 源消息上下文在内存中保留的时间 (秒)，覆盖同一消息分发到各目标的处理窗口
+SOURCE_CONTEXT_TTL = 120
+# 重放任务还原失败 (网络错误等) 时的最大退避间隔 (秒)
+REPLAY_MAX_BACKOFF = 60
+# 暂时性错误 (FloodWait 除外) 的最大重试次数，超过后移入 dead_tasks
+REPLAY_MAX_ATTEMPTS = 8
+# 可重试的暂时性错误；其余 (无权访问源群、实体丢失等) 重试也不会成功
+TRANSIENT_ERRORS = (ServerError, TimedOutError, ConnectionError, asyncio.TimeoutError)
+# Telegram 相册最多 10 个媒体
+ALBUM_MAX_ITEMS = 10
+# 相册发出后仍记录其 grouped_id 的时间 (秒)，用于统计迟到分片
+ALBUM_LATE_WINDOW = 60
+
+
+class SourceContext:
+    """单条源消息的发送者/会话信息及与目标无关的头部片段，在所有目标间共享"""
+
+    def __init__(self, message, sender, chat, tz, timezone_str):
+        self.sender = sender
+        self.chat = chat
+        self.sender_id = sender.id if sender else 0
+
+        sender_name = getattr(sender, 'first_name', 'Unknown')
+        if hasattr(sender, 'last_name') and sender.last_name:
+            sender_name += f" {sender.last_name}"
+        self.sender_name = sender_name
+        self.sender_username = f"@{sender.username}" if hasattr(sender, 'username') and sender.username else ""
+        self.sender_username_lower = sender.username.lower() if self.sender_username else None
+
+        self.msg_date = message.date.astimezone(tz)
+        self.time_str_full = self.msg_date.strftime('%Y-%m-%d %H:%M:%S')
+        self.header_tail = self._build_header_tail(message, chat, timezone_str)
+
+    def _build_header_tail(self, message, chat, timezone_str):
+        """时间/原文链接/编辑/转发等行 (不含分隔线)"""
+        tail = f"\n🕐 {self.time_str_full} ({timezone_str})\n"
+
+        if chat:
+            link = ""
+            if getattr(chat, "username", None):
+                link = f"https://t.me/{chat.username}/{message.id}"
+            else:
+                cid = str(chat.id)
+                if cid.startswith("-100"):
+                    cid = cid[4:]
+                elif cid.startswith("-"):
+                    cid = cid[1:]
+                if cid:
+                     link = f"https://t.me/c/{cid}/{message.id}"
+
+            if link:
+                tail += f"🔗 [跳转原文]({link})\n"
+
+        if message.edit_date:
+            tail += "✏️ (已编辑)\n"
+
+        fwd_from = message.fwd_from
+        if fwd_from:
+            try:
+                fwd_name = fwd_from.from_name
+                # Fallback to implicit handling for hidden senders if needed
+                if fwd_name:
+                     tail += f"↩️ 转发自: {fwd_name}\n"
+                else:
+                     tail += "↩️ 转发消息\n"
+            except:
+                tail += "↩️ 转发消息\n"
+        return tail
+
+
 class MessageHandler:
     """处理消息逻辑"""
     
-    def __init__(self, client, config, mapper, chat_states):
+    def __init__(self, client, config, mapper, chat_states, entity_cache=None, journal=None, scheduler=None):
         self.client = client
         self.config = config
         self.mapper = mapper
         self.chat_states = chat_states
-        self.logger = logging.getLogger(__name__)
+        self.entity_cache = entity_cache or EntityCache(client)
+        self.journal = journal # TaskJournal, None = in-memory queues only
+        self.scheduler = scheduler or SendScheduler() # Shared budget for all outbound calls
         self.logger = logging.getLogger(__name__)
         self._queues = {}
         self._workers = {}
+        self._worker_stats = {} # queue_key -> counters / lag
+        self._spill_counts = {} # queue_key -> tasks waiting only in the journal
         self._album_buffers = {} # Key: (queue_key, grouped_id) -> [messages]
-        self.focus_users = self._parse_focus_users()
-
-    def _parse_focus_users(self):
-        raw = self.config.get('settings', {}).get('focus_users', [])
-        focused = set()
-        for u in raw:
-            if isinstance(u, int):
-                focused.add(u)
-            elif isinstance(u, str):
-                focused.add(u.lstrip('@').lower())
-        return focused
+        self._source_contexts = {} # Key: (chat_id, msg_id) -> Task[SourceContext]
+        self._recent_albums = {} # Recently flushed album buffer keys, to detect late parts
+        self.album_latency = LatencyHistogram()
+        self.album_late_parts = 0
+        self._pending_edits = {} # Key: (target_id, backup_msg_id) -> (queue_key, msg, backup, journal_id)
+        self.edit_counters = {'received': 0, 'coalesced': 0, 'applied': 0}
+        self.backup_texts = BackupTextCache(self.config.get('settings', {}).get('backup_text_cache_size', 5000))
+        self.focus_users = frozenset(parse_focus_users(self.config.get('settings', {}).get('focus_users', [])))
+        self.timezone_str = self.config.get('settings', {}).get('timezone', 'Asia/Tokyo')
+        self.tz = resolve_timezone(self.timezone_str)
+        self._renderers = {} # Key: (source_chat_id, source_topic_id, target_id, target_topic_id) -> TargetRenderer
+        self.overflow_policy = self.config.get('settings', {}).get('queue_overflow_policy', 'block')
+        if self.overflow_policy == 'spill' and not self.journal:
+            # spill 只能溢出到任务日志，未启用日志时明确退回 block
+            self.logger.warning("queue_overflow_policy 'spill' requires durable_queue, falling back to 'block'")
+            self.overflow_policy = 'block'
+
+    def compile_renderers(self, source_map):
+        """启动时为每个 (源, 目标) 配置预编译头部渲染器"""
+        self._renderers = {}
+        for source_id, targets in source_map.items():
+            for target_info in targets:
+                self._get_renderer(source_id, target_info)
+        self.logger.info(f"Compiled {len(self._renderers)} target renderers")
+
+    def _get_renderer(self, source_chat_id, target_info):
+        key = (source_chat_id, target_info.get('source_topic_id'),
+               target_info['target_id'], target_info.get('target_topic_id'))
+        renderer = self._renderers.get(key)
+        if renderer is None:
+            # 未预编译 (例如重放旧配置下的任务) 时按需编译
+            renderer = self._renderers[key] = TargetRenderer(target_info, self.focus_users)
+        return renderer
 
     def _get_queue_key(self, target_info):
         target_id = target_info['target_id']
@@ -37,30 +141,151 @@ class MessageHandler:
 
     async def _get_queue(self, target_id):
         if target_id not in self._queues:
-            self._queues[target_id] = asyncio.Queue()
+            max_size = self.config.get('settings', {}).get('queue_max_size', 1000)
+            self._queues[target_id] = asyncio.Queue(maxsize=max(0, int(max_size)))
+            self._worker_stats.setdefault(target_id, {'processed': 0, 'dropped': 0, 'spilled': 0,
+                                                      'last_lag': 0.0, 'max_lag': 0.0})
             self._workers[target_id] = asyncio.create_task(self._worker_loop(target_id))
         return self._queues[target_id]
 
+    async def _enqueue(self, queue_key, task_type, args):
+        """任务先写入日志，再按溢出策略 (block / spill / drop) 放入目标队列"""
+        queue = await self._get_queue(queue_key)
+        policy = self.overflow_policy
+        
+        # 已有只在磁盘上的任务 (溢出或重放中) 时新任务也只写磁盘，保证同一目标内顺序
+        if self._spill_counts.get(queue_key) and self.journal:
+            self._spill_task(queue_key, task_type, args)
+            return
+        if queue.full():
+            if policy == 'drop':
+                stats = self._worker_stats[queue_key]
+                stats['dropped'] += 1
+                if stats['dropped'] == 1 or stats['dropped'] % 100 == 0:
+                    self.logger.error(
+                        f"Queue {queue_key} full ({queue.qsize()}), dropped {task_type} task "
+                        f"(total dropped: {stats['dropped']})"
+                    )
+                return
+            if policy == 'spill':
+                self._spill_task(queue_key, task_type, args)
+                return
+        
+        journal_id = self._journal_task(queue_key, task_type, args)
+        # block: 队列满时反压到事件分发
+        await queue.put((task_type, args, time.monotonic(), journal_id))
+
+    def _journal_task(self, queue_key, task_type, args, spilled=False):
+        if not self.journal:
+            return None
+        try:
+            return self.journal.add(queue_key, encode_task(task_type, args), spilled=spilled)
+        except Exception as e:
+            self.logger.error(f"Failed to journal {task_type} task for {queue_key}: {e}")
+            return None
+
+    def _spill_task(self, queue_key, task_type, args):
+        if self._journal_task(queue_key, task_type, args, spilled=True) is None:
+            return
+        self._spill_counts[queue_key] = self._spill_counts.get(queue_key, 0) + 1
+        self._worker_stats[queue_key]['spilled'] += 1
+
+    def _ack(self, journal_id):
+        if journal_id is None or not self.journal:
+            return
+        try:
+            self.journal.ack(journal_id)
+        except Exception as e:
+            self.logger.error(f"Failed to ack journal task {journal_id}: {e}")
+
+    async def restore_pending(self):
+        """启动时重放上次未完成的任务 (在注册事件处理前调用)"""
+        if not self.journal:
+            return
+        pending = self.journal.spill_all()
+        for queue_key, count in pending.items():
+            self._spill_counts[queue_key] = count
+            await self._get_queue(queue_key)
+        if pending:
+            self.logger.info(f"Replaying {sum(pending.values())} pending forward tasks for {len(pending)} targets")
+
+    async def _drain_spill(self, queue_key):
+        """内存队列空闲后按入队顺序处理只在磁盘上的任务"""
+        while True:
+            rows = self.journal.spilled(queue_key)
+            if not rows:
+                self._spill_counts[queue_key] = 0
+                return
+            for journal_id, payload in rows:
+                try:
+                    task = await self._decode_journaled(queue_key, journal_id, payload)
+                except Exception as e:
+                    self._dead_letter(queue_key, journal_id, e)
+                else:
+                    # None 表示源消息已不存在，直接确认
+                    if task:
+                        await self._run_task(queue_key, *task, replayed=True)
+                    self._ack(journal_id)
+                self._spill_counts[queue_key] = max(0, self._spill_counts.get(queue_key, 0) - 1)
+
+    async def _decode_journaled(self, queue_key, journal_id, payload):
+        """还原日志中的任务; FloodWait / 网络错误退避重试，永久性错误或重试耗尽时抛出"""
+        delay = 1
+        attempts = 0
+        while True:
+            try:
+                return await decode_task(self.client, payload)
+            except FloodWaitError as e:
+                wait, error = e.seconds, e
+            except TRANSIENT_ERRORS as e:
+                attempts += 1
+                if attempts >= REPLAY_MAX_ATTEMPTS:
+                    raise
+                wait, error = delay, e
+                delay = min(delay * 2, REPLAY_MAX_BACKOFF)
+            self.logger.warning(
+                f"Failed to restore journaled task {journal_id} for {queue_key}, retrying in {wait}s: {error}"
+            )
+            await asyncio.sleep(wait)
+
+    def _dead_letter(self, queue_key, journal_id, error):
+        self.logger.error(
+            f"Giving up on journaled task {journal_id} for {queue_key}, moved to dead_tasks: "
+            f"{type(error).__name__}: {error}"
+        )
+        try:
+            self.journal.dead_letter(journal_id, f"{type(error).__name__}: {error}")
+        except Exception as e:
+            self.logger.error(f"Failed to dead-letter journal task {journal_id}: {e}")
+            self._ack(journal_id)
+
     async def _worker_loop(self, target_id):
         queue = await self._get_queue(target_id)
+        idle_timeout = self.config.get('settings', {}).get('worker_idle_timeout', 600)
         while True:
             try:
-                task_type, args = await queue.get()
+                if queue.empty() and self._spill_counts.get(target_id):
+                    await self._drain_spill(target_id)
+                    continue
+                
                 try:
-                    if task_type == 'new':
-                        await self._process_single_target(*args)
-                    elif task_type == 'album':
-                        await self._process_album_target(*args)
-                    elif task_type == 'album':
-                        await self._process_album_target(*args)
-                    elif task_type == 'edit':
-                        await self._process_edit_target(*args)
-                    elif task_type == 'delete':
-                        await self._process_delete_target(*args)
-                    elif task_type == 'reaction':
-                        await self._process_reaction_target(*args)
-                except Exception as e:
-                    self.logger.error(f"Worker {target_id} error processing {task_type}: {e}", exc_info=True)
+                    task_type, args, enqueued_at, journal_id = await asyncio.wait_for(queue.get(), idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty() and not self._spill_counts.get(target_id):
+                        # 空闲回收，下次有任务时由 _get_queue 重新创建
+                        self._queues.pop(target_id, None)
+                        self._workers.pop(target_id, None)
+                        self.logger.info(f"Worker {target_id} reaped after {idle_timeout}s idle")
+                        return
+                    continue
+                
+                try:
+                    lag = time.monotonic() - enqueued_at
+                    stats = self._worker_stats[target_id]
+                    stats['last_lag'] = lag
+                    stats['max_lag'] = max(stats['max_lag'], lag)
+                    await self._run_task(target_id, task_type, args)
+                    self._ack(journal_id)
                 finally:
                     queue.task_done()
             except asyncio.CancelledError:
@@ -69,6 +294,59 @@ class MessageHandler:
                 self.logger.error(f"Worker {target_id} critical error: {e}", exc_info=True)
                 await asyncio.sleep(1)
 
+    async def _already_forwarded(self, message, target_id, target_info):
+        """重放幂等: 源消息已有到该目标的映射则视为已转发 (映射仍在加载时等待加载完成)
+
+        只用于日志中的任务；实时消息不可能已有映射，检查会白等映射加载。
+        """
+        topic_id = target_info.get('target_topic_id')
+        for backup in await self._get_backup_msgs(message.chat_id, message.id):
+            if str(backup.get('backup_chat_id')) == str(target_id) and backup.get('target_topic_id') == topic_id:
+                return True
+        return False
+
+    async def _run_task(self, target_id, task_type, args, replayed=False):
+        """replayed: 任务来自日志 (可能在上次运行中已发出)，需要先做幂等检查"""
+        try:
+            if replayed and task_type in ('new', 'album'):
+                first_msg = args[0][0] if task_type == 'album' else args[0]
+                if await self._already_forwarded(first_msg, args[1], args[2]):
+                    self.logger.info(f"Skipping already forwarded msg {first_msg.id} to {target_id}")
+                    return
+            if task_type == 'new':
+                await self._process_single_target(*args)
+            elif task_type == 'album':
+                await self._process_album_target(*args)
+            elif task_type == 'edit':
+                await self._process_edit_target(*args)
+            elif task_type == 'delete':
+                await self._process_delete_target(*args)
+            elif task_type == 'delete_batch':
+                await self._process_delete_batch(*args)
+            elif task_type == 'reaction':
+                await self._process_reaction_target(*args)
+        except Exception as e:
+            self.logger.error(f"Worker {target_id} error processing {task_type}: {e}", exc_info=True)
+        finally:
+            self._worker_stats[target_id]['processed'] += 1
+
+    def queue_stats(self) -> dict:
+        """各目标队列深度、溢出/丢弃计数与处理延迟"""
+        result = {}
+        for key, stats in self._worker_stats.items():
+            queue = self._queues.get(key)
+            result[f"{key[0]}/{key[1]}"] = {
+                "depth": queue.qsize() if queue else 0,
+                "spill_pending": self._spill_counts.get(key, 0),
+                "active": key in self._workers,
+                "processed": stats['processed'],
+                "dropped": stats['dropped'],
+                "spilled": stats['spilled'],
+                "last_lag": round(stats['last_lag'], 3),
+                "max_lag": round(stats['max_lag'], 3),
+            }
+        return result
+
     def _get_topic_id(self, message):
         """Get the topic ID of the message if applicable"""
         if not hasattr(message, 'reply_to') or not message.reply_to:
@@ -89,7 +367,6 @@ class MessageHandler:
                 return
             
             chat_id = message.chat_id
-            # sender fetching moved to worker to speed up dispatch
             
             # Get message topic ID (if any)
             msg_topic_id = self._get_topic_id(message)
@@ -109,9 +386,10 @@ class MessageHandler:
                     # Handle Album
                     await self._handle_grouped_message(message, target_info, queue_key)
                 else:
+                    # 发送者/会话解析只做一次，与各目标排队并行进行
+                    self._get_source_context(message)
                     self.logger.info(f"Queuing msg {message.id} from {chat_id} to {queue_key}")
-                    queue = await self._get_queue(queue_key)
-                    await queue.put(('new', (message, target_id, target_info)))
+                    await self._enqueue(queue_key, 'new', (message, target_id, target_info))
         except Exception as e:
             self.logger.error(f"处理新消息失败: {e}", exc_info=True)
 
@@ -119,31 +397,102 @@ class MessageHandler:
         """Buffer grouped messages and schedule flush"""
         grouped_id = message.grouped_id
         buffer_key = (queue_key, grouped_id)
+        now = time.monotonic()
         
-        if buffer_key not in self._album_buffers:
-            self._album_buffers[buffer_key] = []
+        buffer = self._album_buffers.get(buffer_key)
+        if buffer is None:
+            if buffer_key in self._recent_albums:
+                # 相册已经发出后才到达的分片，只能作为新相册单独发送
+                self.album_late_parts += 1
+                self.logger.warning(f"Late part {message.id} for already flushed album {grouped_id} to {queue_key}")
+            buffer = self._album_buffers[buffer_key] = {'messages': [], 'first_seen': now, 'last_seen': now}
             # Schedule flush
             asyncio.create_task(self._flush_album(buffer_key, target_info, queue_key))
             
-        self._album_buffers[buffer_key].append(message)
+        buffer['messages'].append(message)
+        buffer['last_seen'] = now
+        if len(buffer['messages']) >= ALBUM_MAX_ITEMS:
+            # 相册已满，立即唤醒 flush
+            waiter = buffer.get('waiter')
+            if waiter and not waiter.done():
+                waiter.set_result(None)
 
     async def _flush_album(self, buffer_key, target_info, queue_key):
-        """Wait for album to complete then collect and queue"""
-        # Wait for other parts to arrive
-        await asyncio.sleep(2.0)
+        """Wait until the album is complete (full, idle gap elapsed or max wait reached) then queue it"""
+        settings = self.config.get('settings', {})
+        idle_gap = settings.get('album_idle_gap', 0.5)
+        max_wait = settings.get('album_max_wait', 3.0)
+        loop = asyncio.get_running_loop()
+        
+        buffer = self._album_buffers[buffer_key]
+        while len(buffer['messages']) < ALBUM_MAX_ITEMS:
+            deadline = min(buffer['last_seen'] + idle_gap, buffer['first_seen'] + max_wait)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            buffer['waiter'] = loop.create_future()
+            try:
+                await asyncio.wait_for(buffer['waiter'], delay)
+            except asyncio.TimeoutError:
+                pass
         
-        messages = self._album_buffers.pop(buffer_key, [])
+        self._album_buffers.pop(buffer_key, None)
+        self.album_latency.observe(time.monotonic() - buffer['first_seen'])
+        self._recent_albums[buffer_key] = None
+        loop.call_later(ALBUM_LATE_WINDOW, self._recent_albums.pop, buffer_key, None)
+        
+        messages = buffer['messages']
         if not messages:
             return
             
         # Sort by message ID to ensure order
         messages.sort(key=lambda m: m.id)
+        self._get_source_context(messages[0])
         
         target_id = target_info['target_id']
         self.logger.info(f"Queuing album {buffer_key[1]} ({len(messages)} msgs) to {queue_key}")
         
-        queue = await self._get_queue(queue_key)
-        await queue.put(('album', (messages, target_id, target_info)))
+        await self._enqueue(queue_key, 'album', (messages, target_id, target_info))
+
+    def _get_source_context(self, message):
+        """获取 (必要时开始解析) 源消息共享上下文，返回可被多个 worker 等待的 Task"""
+        key = (message.chat_id, message.id)
+        task = self._source_contexts.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve_source_context(message))
+            self._source_contexts[key] = task
+            asyncio.get_running_loop().call_later(SOURCE_CONTEXT_TTL, self._source_contexts.pop, key, None)
+        return task
+
+    async def _resolve_source_context(self, message):
+        cache = self.entity_cache
+        try:
+            sender = cache.get(message.sender_id)
+            if sender is None:
+                sender = await message.get_sender()
+                cache.put(sender, message.sender_id)
+            try:
+                chat = cache.get(message.chat_id)
+                if chat is None:
+                    chat = await message.get_chat()
+                    cache.put(chat, message.chat_id)
+            except Exception:
+                chat = None
+        except Exception as e:
+            self.logger.warning(f"Failed to get sender for {message.id}: {e}")
+            sender = None
+            chat = None
+        return SourceContext(message, sender, chat, self.tz, self.timezone_str)
+
+    def album_stats(self) -> dict:
+        return {
+            "pending": len(self._album_buffers),
+            "late_parts": self.album_late_parts,
+            "latency": self.album_latency.snapshot(),
+        }
+
+    def edit_stats(self) -> dict:
+        return dict(self.edit_counters, pending=len(self._pending_edits))
 
     def _get_fwd_sig(self, message):
         """Get unique signature for forward source to detect context changes"""
@@ -158,25 +507,12 @@ class MessageHandler:
 
     async def _process_single_target(self, message, target_id, target_info):
         """处理单个目标的转发逻辑"""
-        try:
-            sender = await message.get_sender()
-            try:
-                chat = await message.get_chat()
-            except Exception:
-                chat = None
-        except Exception as e:
-            self.logger.warning(f"Failed to get sender for {message.id}: {e}")
-            sender = None
+        # shield: 某个 worker 被取消时不影响其它目标共享的解析任务
+        ctx = await asyncio.shield(self._get_source_context(message))
+        sender_id = ctx.sender_id
             
-        sender_id = sender.id if sender else 0
-
-        sender_name = getattr(sender, 'first_name', 'Unknown')
-        if hasattr(sender, 'last_name') and sender.last_name:
-            sender_name += f" {sender.last_name}"
-            
-        # 检查是否需要发送头部
-        target_topic_id = target_info.get('target_topic_id')
-        state_key = (target_id, target_topic_id) if target_topic_id else target_id
+        # 检查是否需要发送头部 (与相册共用 queue_key 作为状态 key)
+        state_key = self._get_queue_key(target_info)
 
         # Get fwd signature
         fwd_sig = self._get_fwd_sig(message)
@@ -192,27 +528,15 @@ class MessageHandler:
         # 更新状态
         self.chat_states[state_key] = {'last_sender_id': sender_id, 'last_fwd_sig': fwd_sig}
         
-        # 获取配置时区
-        timezone_str = self.config.get('settings', {}).get('timezone', 'Asia/Tokyo')
-        try:
-            tz = pytz.timezone(timezone_str)
-        except Exception:
-            tz = pytz.utc
-        
-        # 转换时间
-        msg_date = message.date.astimezone(tz)
-        time_str_full = msg_date.strftime('%Y-%m-%d %H:%M:%S') # HEADER / FOOTER
+        time_str_full = ctx.time_str_full # HEADER / FOOTER
         
         # 判断是否为富媒体消息
         is_rich_media = bool(message.media and not isinstance(message.media, MessageMediaWebPage))
 
         header = ""
         if should_send_header:
-            header = self._build_message_header(sender, target_info, msg_date, timezone_str, chat, message.id, bool(message.edit_date), message.fwd_from)
-            # Remove separator if rich media?
-            # Original logic: separator = "" if is_rich_media else ...
-            if is_rich_media:
-                 header = header.replace("─" * 30 + "\n", "")
+            # Rich media captions carry no separator line
+            header = self._get_renderer(message.chat_id, target_info).render_header(ctx, separator=not is_rich_media)
 
         # 构建内容 (Header + Text + Footer)
         msg_content = header
@@ -224,7 +548,7 @@ class MessageHandler:
              msg_content += f"\n\n`{time_str_full}`"
 
         # 查找回复
-        reply_to = self._find_reply_to(message.chat_id, message.reply_to_msg_id, target_id)
+        reply_to = await self._find_reply_to(message.chat_id, message.reply_to_msg_id, target_id)
         
         # 如果未找到回复对象，且指定了目标 Topic，则回复到 Topic ID
         target_topic_id = target_info.get('target_topic_id')
@@ -240,6 +564,7 @@ class MessageHandler:
             
         # 记录映射
         if backup_msg:
+             self.backup_texts.put_message(target_id, backup_msg)
              target_topic_id = target_info.get('target_topic_id')
              self.mapper.add_mapping(
                 message.chat_id, 
@@ -256,19 +581,9 @@ class MessageHandler:
         # Use first message for header/metadata info
         first_msg = messages[0]
         
-        # Fetch sender (try first msg)
-        try:
-            sender = await first_msg.get_sender()
-            try:
-                chat = await first_msg.get_chat()
-            except Exception:
-                chat = None
-        except:
-            sender = None
-        sender_id = sender.id if sender else 0
-        sender_name = getattr(sender, 'first_name', 'Unknown')
-        if hasattr(sender, 'last_name') and sender.last_name:
-            sender_name += f" {sender.last_name}"
+        # 发送者/会话按源消息共享 (同一相册发往多个目标时只解析一次)
+        ctx = await asyncio.shield(self._get_source_context(first_msg))
+        sender_id = ctx.sender_id
 
         # Setup State & Header
         queue_key = self._get_queue_key(target_info)
@@ -284,24 +599,11 @@ class MessageHandler:
         
         self.chat_states[queue_key] = {'last_sender_id': sender_id, 'last_fwd_sig': fwd_sig}
 
-        # Time Info
-        timezone_str = self.config.get('settings', {}).get('timezone', 'Asia/Tokyo')
-        try:
-            tz = pytz.timezone(timezone_str)
-        except:
-            tz = pytz.utc
-        msg_date = first_msg.date.astimezone(tz)
-        time_str_full = msg_date.strftime('%Y-%m-%d %H:%M:%S')
-
         # Build Header
         header = ""
         if should_send_header:
-            header = self._build_message_header(
-                sender, target_info, msg_date, timezone_str, 
-                chat, first_msg.id, bool(first_msg.edit_date), first_msg.fwd_from
-            )
-            # Albums are always rich media, so strip separator
-            header = header.replace("─" * 30 + "\n", "")
+            # Albums are always rich media, so no separator
+            header = self._get_renderer(first_msg.chat_id, target_info).render_header(ctx, separator=False)
             # Add extra newline for visual separation in caption
             header += "\n"
 
@@ -328,7 +630,7 @@ class MessageHandler:
             captions.append(cap)
             
         # Reply Target
-        reply_to = self._find_reply_to(first_msg.chat_id, first_msg.reply_to_msg_id, target_id)
+        reply_to = await self._find_reply_to(first_msg.chat_id, first_msg.reply_to_msg_id, target_id)
         if not reply_to and target_info.get('target_topic_id'):
             reply_to = target_info.get('target_topic_id')
             
@@ -336,7 +638,8 @@ class MessageHandler:
         media_list = [m.media for m in messages]
         
         try:
-            sent_messages = await self.client.send_file(
+            sent_messages = await self.scheduler.call(
+                target_id, PRIORITY_NEW, self.client.send_file,
                 target_id,
                 media_list,
                 caption=captions,
@@ -352,6 +655,7 @@ class MessageHandler:
             if len(sent_messages) == len(messages):
                 for i, sent_m in enumerate(sent_messages):
                     orig_m = messages[i]
+                    self.backup_texts.put_message(target_id, sent_m)
                     self.mapper.add_mapping(
                         orig_m.chat_id,
                         orig_m.id,
@@ -369,7 +673,8 @@ class MessageHandler:
     async def _send_media(self, target_id, message, msg_content, should_send_header, time_str, reply_to):
         """发送媒体消息"""
         if isinstance(message.media, MessageMediaWebPage):
-            return await self.client.send_message(
+            return await self.scheduler.call(
+                target_id, PRIORITY_NEW, self.client.send_message,
                 target_id,
                 msg_content or "",
                 link_preview=True,
@@ -383,13 +688,15 @@ class MessageHandler:
         if not caption and not should_send_header: 
                 caption = f"`{time_str}`"
         if is_media_only and should_send_header:
-            backup_msg = await self.client.send_file(
+            backup_msg = await self.scheduler.call(
+                target_id, PRIORITY_NEW, self.client.send_file,
                 target_id,
                 message.media,
                 reply_to=reply_to
             )
             if msg_content:
-                await self.client.send_message(
+                await self.scheduler.call(
+                    target_id, PRIORITY_NEW, self.client.send_message,
                     target_id,
                     msg_content,
                     link_preview=False,
@@ -397,7 +704,8 @@ class MessageHandler:
                 )
             return backup_msg
 
-        return await self.client.send_file(
+        return await self.scheduler.call(
+            target_id, PRIORITY_NEW, self.client.send_file,
             target_id,
             message.media,
             caption=caption,
@@ -406,104 +714,28 @@ class MessageHandler:
 
     async def _send_text(self, target_id, content, reply_to):
         """发送文本消息"""
-        return await self.client.send_message(
+        return await self.scheduler.call(
+            target_id, PRIORITY_NEW, self.client.send_message,
             target_id,
             content,
             link_preview=False,
             reply_to=reply_to
         )
 
-    def _build_avatar_icon(self, sender_name):
-        """使用文本图标模拟头像显示。"""
-        if sender_name:
-            return f"🧑[{sender_name[0]}]"
-        return "🧑"
-
-    def _build_message_header(self, sender, target_info, msg_date, timezone_str, chat, message_id, is_edit=False, fwd_from=None):
-        sender_name = getattr(sender, 'first_name', 'Unknown')
-        if hasattr(sender, 'last_name') and sender.last_name:
-            sender_name += f" {sender.last_name}"
-        
-        is_focused = False
-        if sender:
-            # Combine all focus users
-            current_focus_set = self.focus_users.copy() # Global
-            
-            # Source Level
-            source_focus = target_info.get('source_focus_users', [])
-            current_focus_set.update(self._parse_raw_users(source_focus))
-            
-            # Target Level
-            target_focus = target_info.get('target_focus_users', [])
-            current_focus_set.update(self._parse_raw_users(target_focus))
-            
-            if sender.id in current_focus_set:
-                is_focused = True
-            elif hasattr(sender, 'username') and sender.username and sender.username.lower() in current_focus_set:
-                is_focused = True
-                
-        if is_focused:
-            sender_name = f"**{sender_name}**"
-        
-        sender_username = f"@{sender.username}" if hasattr(sender, 'username') and sender.username else ""
-        avatar_icon = self._build_avatar_icon(sender_name)
-        header = f"{avatar_icon} {sender_name} {sender_username}"
-        
-        if target_info.get('name'):
-            header += f"\n📢 {target_info['name']}"
-        if target_info.get('tag'):
-            header += f" {target_info['tag']}"
-        
-        time_str_full = msg_date.strftime('%Y-%m-%d %H:%M:%S')
-        header += f"\n🕐 {time_str_full} ({timezone_str})\n"
-        
-        if chat:
-            link = ""
-            if getattr(chat, "username", None):
-                link = f"https://t.me/{chat.username}/{message_id}"
-            else:
-                cid = str(chat.id)
-                if cid.startswith("-100"):
-                    cid = cid[4:]
-                elif cid.startswith("-"):
-                    cid = cid[1:]
-                if cid:
-                     link = f"https://t.me/c/{cid}/{message_id}"
-            
-            if link:
-                header += f"🔗 [跳转原文]({link})\n"
-        
-        if is_edit:
-            header += "✏️ (已编辑)\n"
-
-        if fwd_from:
-            try:
-                fwd_name = fwd_from.from_name
-                # Fallback to implicit handling for hidden senders if needed
-                if fwd_name:
-                     header += f"↩️ 转发自: {fwd_name}\n"
-                else:
-                     header += "↩️ 转发消息\n"
-            except:
-                header += "↩️ 转发消息\n"
-
-        return header + ("─" * 30 + "\n")
-
-    def _parse_raw_users(self, raw_list):
-        parsed = set()
-        for u in raw_list:
-            if isinstance(u, int):
-                parsed.add(u)
-            elif isinstance(u, str):
-                parsed.add(u.lstrip('@').lower())
-        return parsed
+    async def _get_backup_msgs(self, chat_id, msg_id):
+        """查询映射；映射仍在后台加载且未命中时等待加载完成再查"""
+        backups = self.mapper.get_backup_msgs(chat_id, msg_id)
+        if not backups and not self.mapper.loaded:
+            await self.mapper.wait_until_loaded()
+            backups = self.mapper.get_backup_msgs(chat_id, msg_id)
+        return backups
 
-    def _find_reply_to(self, chat_id, reply_to_msg_id, target_id):
+    async def _find_reply_to(self, chat_id, reply_to_msg_id, target_id):
         """查找回复目标ID"""
         if not reply_to_msg_id:
             return None
             
-        backup_msgs = self.mapper.get_backup_msgs(chat_id, reply_to_msg_id)
+        backup_msgs = await self._get_backup_msgs(chat_id, reply_to_msg_id)
         for bm in backup_msgs:
             # Coerce to string for safe comparison (JSON ids might be loaded as int or str)
             # target_id is usually int from core.py
@@ -535,7 +767,7 @@ class MessageHandler:
                 return
 
             # Use Mapping to determine where to send edits
-            backups = self.mapper.get_backup_msgs(chat_id, msg_id)
+            backups = await self._get_backup_msgs(chat_id, msg_id)
             if not backups:
                 return
 
@@ -543,16 +775,78 @@ class MessageHandler:
             # Actually each backup entry corresponds to a specific message on a specific target.
             # We should dispatch individual tasks for each backup entry.
             
+            window = self.config.get('settings', {}).get('edit_debounce_window', 2.0)
             for backup in backups:
                 target_id = backup['backup_chat_id']
                 topic_id = backup.get('target_topic_id')
                 queue_key = (target_id, topic_id)
+                self.edit_counters['received'] += 1
+                
+                if window <= 0:
+                    await self._enqueue(queue_key, 'edit', (msg, target_id, backup)) # Pass backup entry instead of target_info
+                    continue
                 
-                queue = await self._get_queue(queue_key)
-                await queue.put(('edit', (msg, target_id, backup))) # Pass backup entry instead of target_info
+                # Debounce: 窗口内同一备份消息的连续编辑只保留最新一次
+                # 等待中的编辑同样先写入日志 (未放入队列，仅在重启后重放)，替换掉被合并的旧记录
+                edit_key = (target_id, backup['backup_msg_id'])
+                journal_id = self._journal_task(queue_key, 'edit', (msg, target_id, backup))
+                previous = self._pending_edits.get(edit_key)
+                if previous is not None:
+                    self.edit_counters['coalesced'] += 1
+                    self._ack(previous[3])
+                else:
+                    asyncio.get_running_loop().call_later(
+                        window, lambda k=edit_key: asyncio.create_task(self._flush_edit(k))
+                    )
+                self._pending_edits[edit_key] = (queue_key, msg, backup, journal_id)
+
+        except Exception as e:
+            self.logger.error(f"Error dispatching edit: {e}", exc_info=True)
+
+    async def _get_backup_text(self, target_id, backup_msg_id):
+        """读取备份消息当前文本，优先使用本地缓存；消息不存在时返回 None"""
+        text = self.backup_texts.get(target_id, backup_msg_id)
+        if text is not None:
+            return text
+        backup_msg = await self.scheduler.call(
+            target_id, PRIORITY_EDIT, self.client.get_messages, target_id, ids=backup_msg_id, cost=0)
+        if not backup_msg:
+            return None
+        self.backup_texts.put_message(target_id, backup_msg)
+        return backup_msg.text or ""
 
+    async def _get_backup_texts(self, target_id, backup_msg_ids) -> dict:
+        """批量读取备份消息文本，缓存未命中的合并为一次 get_messages；不存在的消息不在结果中"""
+        texts = {}
+        missing = []
+        for backup_msg_id in backup_msg_ids:
+            text = self.backup_texts.get(target_id, backup_msg_id)
+            if text is None:
+                missing.append(backup_msg_id)
+            else:
+                texts[backup_msg_id] = text
+        if missing:
+            fetched = await self.scheduler.call(
+                target_id, PRIORITY_EDIT, self.client.get_messages, target_id, ids=missing, cost=0)
+            for backup_msg in fetched or []:
+                if backup_msg:
+                    self.backup_texts.put_message(target_id, backup_msg)
+                    texts[backup_msg.id] = backup_msg.text or ""
+        return texts
+
+    async def _flush_edit(self, edit_key):
+        """防抖窗口结束，将最新一次编辑放入目标队列"""
+        pending = self._pending_edits.pop(edit_key, None)
+        if pending is None:
+            return
+        queue_key, msg, backup, journal_id = pending
+        try:
+            await self._enqueue(queue_key, 'edit', (msg, edit_key[0], backup))
         except Exception as e:
             self.logger.error(f"Error dispatching edit: {e}", exc_info=True)
+            return
+        # 入队时已重新写入日志，确认等待期间的记录
+        self._ack(journal_id)
 
     async def _process_edit_target(self, msg, target_id, backup_entry):
             # Worker now receives specific backup entry
@@ -564,17 +858,16 @@ class MessageHandler:
                 return
 
             backup_msg_id = backup_entry['backup_msg_id']
+            # A newer edit of the same message is already waiting; apply only that one
+            if (target_id, backup_msg_id) in self._pending_edits:
+                self.edit_counters['coalesced'] += 1
+                return
             # ... process edit ...
             try:
                     # 在原消息后追加编辑记录
-                    current_backup = await self.client.get_messages(target_id, ids=backup_msg_id)
-                    if current_backup:
-                        timezone_str = self.config.get('settings', {}).get('timezone', 'Asia/Tokyo')
-                        try:
-                            tz = pytz.timezone(timezone_str)
-                        except Exception:
-                            tz = pytz.utc
-
+                    current_text = await self._get_backup_text(target_id, backup_msg_id)
+                    if current_text is not None:
+                        tz, timezone_str = self.tz, self.timezone_str
                         edit_time = msg.edit_date.astimezone(tz) if msg.edit_date else datetime.now(tz)
                         edit_time_str = edit_time.strftime('%Y-%m-%d %H:%M:%S')
                         edited_text = msg.text or ""
@@ -583,7 +876,6 @@ class MessageHandler:
                             f"🕐 修改时间: {edit_time_str} ({timezone_str})\n"
                             f"{edited_text}"
                         )
-                        current_text = current_backup.text or ""
                         
                         # Strict De-duplication Logic
                         should_skip = False
@@ -608,8 +900,7 @@ class MessageHandler:
                             # Case 2: No edits yet. Compare against original.
                             # Requires knowing the separator or structure.
                             # Original: Header + Separator + Text + (Footer)
-                            # Separator: "─" * 30 + "\n"
-                            separator = "─" * 30 + "\n"
+                            separator = HEADER_SEPARATOR
                             
                             clean_current = current_text
                             if separator in clean_current:
@@ -633,8 +924,11 @@ class MessageHandler:
                             return 
 
                         self.logger.info(f"Applying edit to {backup_msg_id}")
+                        self.edit_counters['applied'] += 1
                         new_text = f"{current_text}\n\n{edit_entry}" if current_text else edit_entry
-                        await self.client.edit_message(target_id, backup_msg_id, new_text)
+                        edited = await self.scheduler.call(target_id, PRIORITY_EDIT, self.client.edit_message,
+                                                           target_id, backup_msg_id, new_text)
+                        self.backup_texts.put_message(target_id, edited)
                             
             except Exception as e:
                     self.logger.error(f"编辑消息失败 {backup_entry}: {e}")
@@ -648,18 +942,25 @@ class MessageHandler:
             if not msg_ids or not chat_id:
                 return
                 
+            # Group by target queue so a bulk purge becomes one batch task per target
+            grouped = {}
             for msg_id in msg_ids:
-                backups = self.mapper.get_backup_msgs(chat_id, msg_id)
+                backups = await self._get_backup_msgs(chat_id, msg_id)
                 for backup in backups:
                     target_id = backup['backup_chat_id']
                     topic_id = backup.get('target_topic_id')
-                    queue_key = (target_id, topic_id)
-                    
-                    queue = await self._get_queue(queue_key)
-                    # Pass list of ONE backup entry to keep processing logic simple or adapt?
-                    # Original logic processed list of msg_ids.
-                    # Adapting to process single backup entry is cleaner.
-                    await queue.put(('delete', ([msg_id], chat_id, target_id, backup))) 
+                    grouped.setdefault((target_id, topic_id), []).append((msg_id, backup))
+
+            threshold = self.config.get('settings', {}).get('recall_batch_threshold', 3)
+            for queue_key, items in grouped.items():
+                target_id = queue_key[0]
+                if len(items) >= threshold:
+                    await self._enqueue(queue_key, 'delete_batch', (
+                        [msg_id for msg_id, _ in items], chat_id, target_id, [backup for _, backup in items]
+                    ))
+                    continue
+                for msg_id, backup in items:
+                    await self._enqueue(queue_key, 'delete', ([msg_id], chat_id, target_id, backup))
 
         except Exception as e:
             self.logger.error(f"Error dispatching delete: {e}", exc_info=True)
@@ -678,23 +979,26 @@ class MessageHandler:
 
                     # 尝试编辑
                     try:
-                        old_msg = await self.client.get_messages(target_id, ids=backup_msg_id)
-                        if old_msg:
-                            text = old_msg.text or ""
+                        text = await self._get_backup_text(target_id, backup_msg_id)
+                        if text is not None:
                             # Check if already recalled
                             if "#已撤回" in text:
                                 return
-                            await self.client.edit_message(target_id, backup_msg_id, text + f"\n\n#已撤回 `{recall_time}`")
+                            edited = await self.scheduler.call(target_id, PRIORITY_EDIT, self.client.edit_message,
+                                                               target_id, backup_msg_id, text + f"\n\n#已撤回 `{recall_time}`")
+                            self.backup_texts.put_message(target_id, edited)
                             
                         # 发送警告
-                        await self.client.send_message(
+                        await self.scheduler.call(
+                            target_id, PRIORITY_EDIT, self.client.send_message,
                             target_id, 
                             f"⚠️ 消息已被撤回 ⚠️\n🕐 撤回时间: {recall_time}",
                             reply_to=backup_msg_id
                         )
                     except Exception as e:
                          # 失败告警
-                         await self.client.send_message(
+                         await self.scheduler.call(
+                            target_id, PRIORITY_EDIT, self.client.send_message,
                             target_id, 
                             f"⚠️ 消息已被撤回 ⚠️\n🕐 撤回时间: {recall_time}\n#已撤回",
                             reply_to=backup_msg_id
@@ -706,6 +1010,43 @@ class MessageHandler:
             # Legacy / Fallback path (should not be hit with new dispatcher)
             pass
 
+    async def _process_delete_batch(self, msg_ids, chat_id, target_id, backup_entries):
+        """批量撤回: 一次读取所有备份消息，逐条标记后只发送一条汇总提醒"""
+        recall_time = datetime.now().strftime('%H:%M:%S')
+        backup_ids = sorted({
+            b['backup_msg_id'] for b in backup_entries
+            if str(b['backup_chat_id']) == str(target_id) and not self._is_auto_delete_ignored(b.get('timestamp'))
+        })
+        if not backup_ids:
+            return
+
+        texts = await self._get_backup_texts(target_id, backup_ids)
+        marked = 0
+        for backup_msg_id in backup_ids:
+            text = texts.get(backup_msg_id)
+            if text is None or "#已撤回" in text:
+                continue
+            try:
+                edited = await self.scheduler.call(target_id, PRIORITY_EDIT, self.client.edit_message,
+                                                   target_id, backup_msg_id, text + f"\n\n#已撤回 `{recall_time}`")
+                self.backup_texts.put_message(target_id, edited)
+                marked += 1
+            except Exception as e:
+                self.logger.error(f"Failed to mark recalled backup {backup_msg_id} in {target_id}: {e}")
+
+        if not marked:
+            return
+        self.logger.info(f"Batch recall: marked {marked}/{len(backup_ids)} backups in {target_id}")
+        try:
+            await self.scheduler.call(
+                target_id, PRIORITY_EDIT, self.client.send_message,
+                target_id,
+                f"⚠️ {marked} 条消息已被撤回 ⚠️\n🕐 撤回时间: {recall_time}\n#已撤回",
+                reply_to=backup_ids[0]
+            )
+        except Exception as e:
+            self.logger.error(f"Batch recall notice failed for {target_id}: {e}")
+
     async def handle_reaction(self, event, target_info_list):
         """处理表情反应"""
         try:
@@ -714,7 +1055,7 @@ class MessageHandler:
             self.logger.info(f"Reaction event received: Source {chat_id} Msg {msg_id}")
 
             # We need to map Source Msg ID -> Target Msg ID
-            backups = self.mapper.get_backup_msgs(chat_id, msg_id)
+            backups = await self._get_backup_msgs(chat_id, msg_id)
             if not backups:
                 return
                 
@@ -724,8 +1065,7 @@ class MessageHandler:
                 topic_id = backup.get('target_topic_id')
                 queue_key = (target_id, topic_id)
                 
-                queue = await self._get_queue(queue_key)
-                await queue.put(('reaction', (event, target_id, backup)))
+                await self._enqueue(queue_key, 'reaction', (event, target_id, backup))
 
         except Exception as e:
             self.logger.error(f"Error dispatching reaction: {e}")
@@ -766,7 +1106,7 @@ class MessageHandler:
             
             # Wrap in list for SendReactionRequest
             reactions_list = [reaction] if reaction else []
-            await self.client(SendReactionRequest(
+            await self.scheduler.call(target_id, PRIORITY_REACTION, self.client, SendReactionRequest(
                 peer=target_id, 
                 msg_id=backup_msg_id, 
                 reaction=reactions_list
@@ -0,0 +1,94 @@
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+
+class TaskJournal:
+    """转发任务日志 (SQLite WAL) - 任务入队即落盘，处理完成后确认删除
+
+    重启后未确认的任务会被重放，实现至少一次投递。
+    spilled=1 的任务只存在于磁盘 (内存队列已满或正在重放)，由 worker 按 id 顺序取出。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: 进程崩溃不丢已提交任务，仅掉电可能丢最后几个事务
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " queue_key TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " spilled INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_spilled ON tasks (queue_key, spilled, id)")
+        # 无法还原的任务移到这里保留备查，不再阻塞所在目标的队列
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_tasks ("
+            " id INTEGER PRIMARY KEY,"
+            " queue_key TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " error TEXT,"
+            " failed_at REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def encode_key(queue_key) -> str:
+        target_id, topic_id = queue_key
+        return f"{target_id}:{topic_id or 0}"
+
+    @staticmethod
+    def decode_key(key: str):
+        target_id, topic_id = key.split(':')
+        return int(target_id), (int(topic_id) or None)
+
+    def add(self, queue_key, payload: dict, spilled: bool = False) -> int:
+        cur = self.conn.execute(
+            "INSERT INTO tasks (queue_key, payload, spilled, created_at) VALUES (?, ?, ?, ?)",
+            (self.encode_key(queue_key), json.dumps(payload, ensure_ascii=False), int(spilled), time.time()),
+        )
+        return cur.lastrowid
+
+    def ack(self, task_id: int):
+        self.conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def dead_letter(self, task_id: int, error: str):
+        """将任务移入 dead_tasks"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dead_tasks (id, queue_key, payload, created_at, error, failed_at)"
+                " SELECT id, queue_key, payload, created_at, ?, ? FROM tasks WHERE id = ?",
+                (error, time.time(), task_id),
+            )
+            self.conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def spilled(self, queue_key, limit: int = 100) -> list:
+        """按入队顺序取出仅在磁盘上的任务: [(id, payload)]"""
+        rows = self.conn.execute(
+            "SELECT id, payload FROM tasks WHERE queue_key = ? AND spilled = 1 ORDER BY id LIMIT ?",
+            (self.encode_key(queue_key), limit),
+        ).fetchall()
+        result = []
+        for task_id, payload in rows:
+            try:
+                result.append((task_id, json.loads(payload)))
+            except ValueError:
+                logging.warning(f"Dropping corrupt journal task {task_id}")
+                self.ack(task_id)
+        return result
+
+    def spill_all(self) -> dict:
+        """启动时将上次未完成的任务全部标记为待重放，返回 {queue_key: 数量}"""
+        self.conn.execute("UPDATE tasks SET spilled = 1 WHERE spilled = 0")
+        rows = self.conn.execute("SELECT queue_key, COUNT(*) FROM tasks GROUP BY queue_key").fetchall()
+        return {self.decode_key(key): count for key, count in rows}
+
+    def close(self):
+        self.conn.close()
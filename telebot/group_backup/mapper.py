@@ -1,135 +1,323 @@
-import json
+import asyncio
 import logging
+import threading
+import time
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime
+
+from .mapping_store import BUCKET_SECONDS, BufferedMappingStore, get_mapping_store
+
+
+class MappingRecord:
+    """单条映射记录 (紧凑表示，时间戳为 epoch 秒)
+
+    兼容旧的 dict 访问方式: record['backup_chat_id'] / record.get('timestamp')。
+    """
+
+    __slots__ = ('source_chat_id', 'source_msg_id', 'backup_chat_id', 'backup_msg_id',
+                 'target_topic_id', 'ts')
+
+    FIELDS = ('source_chat_id', 'source_msg_id', 'backup_chat_id', 'backup_msg_id', 'target_topic_id')
+
+    def __init__(self, source_chat_id, source_msg_id, backup_chat_id, backup_msg_id,
+                 target_topic_id=None, ts=None):
+        self.source_chat_id = source_chat_id
+        self.source_msg_id = source_msg_id
+        self.backup_chat_id = backup_chat_id
+        self.backup_msg_id = backup_msg_id
+        self.target_topic_id = target_topic_id
+        self.ts = ts
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        ts = data.get('ts')
+        if ts is None and data.get('timestamp'):
+            try:
+                ts = int(datetime.fromisoformat(data['timestamp']).timestamp())
+            except ValueError:
+                ts = None
+        return cls(
+            data.get('source_chat_id'),
+            data.get('source_msg_id'),
+            data.get('backup_chat_id'),
+            data.get('backup_msg_id'),
+            data.get('target_topic_id'),
+            ts,
+        )
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.ts).isoformat() if self.ts is not None else None
+
+    def get(self, key, default=None):
+        if key == 'timestamp':
+            value = self.timestamp
+        elif key in self.FIELDS or key == 'ts':
+            value = getattr(self, key)
+        else:
+            return default
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key != 'timestamp' and key != 'ts' and key not in self.FIELDS:
+            raise KeyError(key)
+        return self.timestamp if key == 'timestamp' else getattr(self, key)
+
+    def to_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data['ts'] = self.ts
+        data['timestamp'] = self.timestamp
+        return data
+
+    def __repr__(self):
+        return f"MappingRecord({self.to_dict()})"
+
+
+class MappingBucket:
+    """一个时间桶 (UTC 自然日) 内的映射及其正反向索引"""
+
+    __slots__ = ('day', 'forward', 'reverse', 'size')
+
+    def __init__(self, day: int):
+        self.day = day
+        # source_chat_id -> {source_msg_id: MappingRecord | [MappingRecord, ...]}
+        self.forward = {}
+        # backup_chat_id -> {backup_msg_id: MappingRecord}
+        self.reverse = {}
+        self.size = 0
+
+    def add(self, record: MappingRecord):
+        by_msg = self.forward.setdefault(record.source_chat_id, {})
+        existing = by_msg.get(record.source_msg_id)
+        if existing is None:
+            # 绝大多数源消息只有一个备份，直接存记录省掉 list 开销
+            by_msg[record.source_msg_id] = record
+        elif isinstance(existing, list):
+            existing.append(record)
+        else:
+            by_msg[record.source_msg_id] = [existing, record]
+
+        if record.backup_chat_id and record.backup_msg_id:
+            self.reverse.setdefault(record.backup_chat_id, {})[record.backup_msg_id] = record
+        self.size += 1
+
+    def __iter__(self):
+        for by_msg in self.forward.values():
+            for value in by_msg.values():
+                if isinstance(value, list):
+                    yield from value
+                else:
+                    yield value
+
 
 class MessageMapper:
-    """消息映射管理器 - 用于记录原消息和转发消息的对应关系"""
-    
-    def __init__(self, data_dir: Path):
+    """消息映射管理器 - 用于记录原消息和转发消息的对应关系
+
+    映射按天分桶保存，过期清理整桶丢弃，不触碰仍在保留期内的记录。
+    lazy=True 时不在构造时加载，由 start_loading() 在后台线程从最新的分段开始加载，
+    期间新写入的映射照常可查。
+    """
+
+    def __init__(self, data_dir: Path, backend: str = 'log', flush_interval: float = 1.0,
+                 flush_batch_size: int = 200, lazy: bool = False):
         self.data_dir = data_dir
         self.data_dir.mkdir(parents=True, exist_ok=True)
-        self.mapping_file = self.data_dir / "message_mapping.json"
-        self.mapping = self._load_mapping()
-        self.reverse_mapping = {} # (target_id, msg_id) -> {source_id, source_msg_id}
-        self._build_reverse_index()
-    
-    def _load_mapping(self) -> dict:
-        """加载消息映射"""
-        if self.mapping_file.exists():
-            try:
-                with open(self.mapping_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                logging.error(f"加载消息映射失败: {e}")
-                return {}
-        return {}
-
-    def _build_reverse_index(self):
-        """构建反向索引"""
-        self.reverse_mapping = {}
-        for key, value in self.mapping.items():
-            entries = value if isinstance(value, list) else [value]
-            for entry in entries:
-                tid = entry.get('backup_chat_id')
-                mid = entry.get('backup_msg_id')
-                if tid and mid:
-                    self.reverse_mapping[(tid, mid)] = entry
-
-    def _save_mapping(self):
-        """保存消息映射"""
+        store = get_mapping_store(backend, self.data_dir)
+        if store is None:
+            logging.error(f"未知的映射存储后端: {backend}，使用追加日志后端")
+            store = get_mapping_store('log', self.data_dir)
+        # flush_interval <= 0 表示每条映射同步落盘
+        if flush_interval and flush_interval > 0:
+            store = BufferedMappingStore(store, flush_interval, flush_batch_size)
+        self.store = store
+        # day -> MappingBucket; _days 为升序的桶序号
+        self._buckets = {}
+        self._days = []
+        # 共享 chat_id 整数对象，避免每条记录各持有一份
+        self._chat_ids = {}
+        # 保护桶结构 (后台加载线程与事件循环并发修改)
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._load_thread = None
+        if not lazy:
+            self._load_mapping()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    def prepare(self):
+        """完成存储后端的一次性准备 (旧版映射迁移)，应在开始接收事件前调用"""
+        self.store.prepare()
+
+    def start_loading(self):
+        """在后台线程加载映射 (幂等)"""
+        if self._loaded.is_set() or self._load_thread is not None:
+            return
+        self._load_thread = threading.Thread(target=self._load_mapping, name="mapping-loader", daemon=True)
+        self._load_thread.start()
+
+    async def wait_until_loaded(self, timeout: float = None) -> bool:
+        """等待后台加载完成，返回是否已加载"""
+        if self._loaded.is_set():
+            return True
+        return await asyncio.to_thread(self._loaded.wait, timeout)
+
+    def _load_mapping(self):
+        """加载消息映射并建立正反向索引 (按段加载，最新的先可用)"""
+        start = time.perf_counter()
+        total = 0
         try:
-            with open(self.mapping_file, 'w', encoding='utf-8') as f:
-                json.dump(self.mapping, f, ensure_ascii=False, indent=2)
+            now = int(time.time())
+            for entries in self.store.iter_load():
+                buckets = {}
+                for entry in entries:
+                    record = MappingRecord.from_dict(entry)
+                    if record.ts is None:
+                        # 无时间戳的旧记录从现在开始计算保留期
+                        record.ts = now
+                    day = record.ts // BUCKET_SECONDS
+                    bucket = buckets.get(day)
+                    if bucket is None:
+                        bucket = buckets[day] = MappingBucket(day)
+                    bucket.add(self._intern(record))
+                for bucket in buckets.values():
+                    self._install_bucket(bucket)
+                total += len(entries)
         except Exception as e:
-            logging.error(f"保存消息映射失败: {e}")
-    
-    def add_mapping(self, source_chat_id: int, source_msg_id: int, 
+            logging.error(f"加载消息映射失败: {e}")
+        finally:
+            self._loaded.set()
+        logging.info(
+            f"消息映射加载完成: {total} 条, {len(self._days)} 个时间桶, 耗时 {time.perf_counter() - start:.2f}s"
+        )
+
+    def _install_bucket(self, bucket: MappingBucket):
+        """将加载好的桶并入索引，合并加载期间已写入同一天的新映射"""
+        with self._lock:
+            live = self._buckets.get(bucket.day)
+            if live is not None:
+                for record in live:
+                    # 加载期间新写入的记录可能已被写线程落盘并被读到，避免重复
+                    if bucket.reverse.get(record.backup_chat_id, {}).get(record.backup_msg_id) is None:
+                        bucket.add(record)
+            self._buckets[bucket.day] = bucket
+            if live is None:
+                self._days = sorted([*self._days, bucket.day])
+
+    def _intern(self, record: MappingRecord) -> MappingRecord:
+        chat_ids = self._chat_ids
+        record.source_chat_id = chat_ids.setdefault(record.source_chat_id, record.source_chat_id)
+        record.backup_chat_id = chat_ids.setdefault(record.backup_chat_id, record.backup_chat_id)
+        return record
+
+    def _index_record(self, record: MappingRecord):
+        """将单条映射加入所属时间桶"""
+        day = record.ts // BUCKET_SECONDS
+        with self._lock:
+            bucket = self._buckets.get(day)
+            if bucket is None:
+                bucket = self._buckets[day] = MappingBucket(day)
+                # 查询方可能正在遍历 _days，整体替换而不是原地插入
+                self._days = sorted([*self._days, day])
+            bucket.add(record)
+
+    def _iter_entries(self):
+        for day in self._days:
+            bucket = self._buckets.get(day)
+            if bucket is not None:
+                yield from bucket
+
+    def close(self):
+        """关闭存储后端 (会先落盘缓冲中的映射)"""
+        self.store.close()
+
+    def add_mapping(self, source_chat_id: int, source_msg_id: int,
                     backup_chat_id: int, backup_msg_id: int, target_topic_id: int = None):
         """添加消息映射 (支持一对多)"""
-        key = f"{source_chat_id}_{source_msg_id}"
-        if key not in self.mapping:
-            self.mapping[key] = []
-        
-        entry = {
-            "source_chat_id": source_chat_id,
-            "source_msg_id": source_msg_id,
-            "backup_chat_id": backup_chat_id,
-            "backup_msg_id": backup_msg_id,
-            "target_topic_id": target_topic_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        if isinstance(self.mapping[key], dict):
-            self.mapping[key] = [self.mapping[key]]
-            
-        self.mapping[key].append(entry)
-        
-        # Update reverse index
-        self.reverse_mapping[(backup_chat_id, backup_msg_id)] = entry
-        
-        self._save_mapping()
-    
+        record = self._intern(MappingRecord(
+            source_chat_id, source_msg_id, backup_chat_id, backup_msg_id,
+            target_topic_id, int(time.time())
+        ))
+        self._index_record(record)
+
+        try:
+            self.store.append([record.to_dict()])
+        except Exception as e:
+            logging.error(f"保存消息映射失败: {e}")
+
     def get_backup_msgs(self, source_chat_id: int, source_msg_id: int) -> list:
         """获取对应的备份消息信息列表"""
-        key = f"{source_chat_id}_{source_msg_id}"
-        data = self.mapping.get(key)
-        
-        if not data:
-            return []
-            
-        if isinstance(data, dict):
-            return [data]
-            
-        return data
+        result = []
+        for day in self._days:
+            bucket = self._buckets.get(day)
+            # 遍历期间该桶可能已被清理线程删除
+            if bucket is None:
+                continue
+            data = bucket.forward.get(source_chat_id)
+            if not data:
+                continue
+            data = data.get(source_msg_id)
+            if data is None:
+                continue
+            if isinstance(data, MappingRecord):
+                result.append(data)
+            else:
+                result.extend(data)
+        return result
 
     def get_source_info(self, target_chat_id: int, target_msg_id: int):
         """反向查找：根据备份消息ID获取源信息"""
-        return self.reverse_mapping.get((target_chat_id, target_msg_id))
+        # 从最新的桶开始查，与旧实现中后写入覆盖先写入一致
+        for day in reversed(self._days):
+            bucket = self._buckets.get(day)
+            if bucket is None:
+                continue
+            data = bucket.reverse.get(target_chat_id)
+            if data:
+                record = data.get(target_msg_id)
+                if record is not None:
+                    return record
+        return None
+
+    def find_backup_chats(self, backup_msg_id: int) -> list:
+        """查找包含指定备份消息ID的备份群"""
+        chats = set()
+        with self._lock:
+            buckets = list(self._buckets.values())
+        for bucket in buckets:
+            for tid, by_msg in bucket.reverse.items():
+                if backup_msg_id in by_msg:
+                    chats.add(tid)
+        return list(chats)
+
+    def count(self) -> int:
+        with self._lock:
+            return sum(bucket.size for bucket in self._buckets.values())
 
     def cleanup_old_mappings(self, retention_days: int):
-        """清理过期的映射记录"""
+        """清理过期的映射记录 (整桶丢弃，O(桶数))"""
         if retention_days <= 0:
             return
-            
-        logging.info(f"开始清理超过 {retention_days} 天的消息映射记录...")
-        cutoff_date = datetime.now() - timedelta(days=retention_days)
-        initial_count = len(self.mapping)
-        keys_to_remove = []
-        
-        for key, entries in self.mapping.items():
-            if isinstance(entries, dict):
-                entries = [entries]
-            
-            new_entries = []
-            for entry in entries:
-                ts_str = entry.get('timestamp')
-                if not ts_str:
-                    new_entries.append(entry)
-                    continue
-                    
-                try:
-                    ts = datetime.fromisoformat(ts_str)
-                    if ts > cutoff_date:
-                        new_entries.append(entry)
-                except ValueError:
-                     new_entries.append(entry)
-
-            if not new_entries:
-                keys_to_remove.append(key)
-            else:
-                self.mapping[key] = new_entries
-        
-        for key in keys_to_remove:
-            del self.mapping[key]
-            
-        # Rebuild reverse index after cleanup
-        self._build_reverse_index()
-            
-        final_count = len(self.mapping)
-        removed_count = initial_count - final_count
-        if removed_count > 0 or len(keys_to_remove) > 0:
-            self._save_mapping()
-            logging.info(f"清理完成: 移除了 {removed_count} 个过期条目 (剩余 {final_count})")
-        else:
+        if not self.loaded:
+            logging.info("消息映射仍在加载，跳过本次清理")
+            return
+
+        cutoff_day = int(time.time()) // BUCKET_SECONDS - retention_days
+        with self._lock:
+            expired = [day for day in self._days if day < cutoff_day]
+            # 先发布新的 _days 再删除桶: 查询方在事件循环中无锁遍历 _days
+            self._days = [day for day in self._days if day >= cutoff_day]
+            removed_count = 0
+            for day in expired:
+                removed_count += self._buckets.pop(day).size
+
+        if not expired:
             logging.info("清理完成: 没有发现过期条目")
+            return
+
+        try:
+            self.store.drop_buckets(expired, lambda: [r.to_dict() for r in self._iter_entries()])
+        except Exception as e:
+            logging.error(f"删除过期映射失败: {e}")
+        logging.info(f"清理完成: 移除了 {len(expired)} 个过期时间桶共 {removed_count} 个条目 (剩余 {self.count()})")
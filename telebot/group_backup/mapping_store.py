@@ -0,0 +1,340 @@
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+# 映射按 UTC 自然日分桶
+BUCKET_SECONDS = 86400
+
+
+class MappingStore(ABC):
+    """消息映射持久化后端接口"""
+
+    # 是否能直接按桶删除 (无需 remaining 快照)
+    supports_bucket_drop = False
+
+    @abstractmethod
+    def load(self) -> list:
+        """读取全部映射记录 (按写入顺序)"""
+        pass
+
+    def iter_load(self):
+        """分批读取映射记录，尽量先返回最新的一批 (用于后台加载)"""
+        yield self.load()
+
+    def prepare(self):
+        """加载前的一次性准备 (如迁移旧格式)，须在开始写入前完成"""
+        pass
+
+    @abstractmethod
+    def append(self, entries: list):
+        """追加映射记录"""
+        pass
+
+    @abstractmethod
+    def rewrite(self, entries: list):
+        """用给定记录整体替换存储内容 (用于清理/压缩)"""
+        pass
+
+    def drop_buckets(self, days: list, remaining):
+        """删除整桶 (按天) 过期记录; 默认实现回退为用 remaining() 整体重写"""
+        self.rewrite(remaining())
+
+    def close(self):
+        """释放资源"""
+        pass
+
+
+def bucket_of(entry: dict) -> int:
+    """映射记录所属的时间桶 (UTC 天序号)"""
+    ts = entry.get('ts')
+    if ts is None:
+        ts = time.time()
+    return int(ts) // BUCKET_SECONDS
+
+
+class AppendLogMappingStore(MappingStore):
+    """追加写日志后端 - 按天分段，每条映射一行 JSON，写入代价 O(1)
+
+    过期清理直接删除整段文件。
+    """
+
+    supports_bucket_drop = True
+
+    def __init__(self, data_dir: Path, legacy_files: list = None):
+        self.segment_dir = data_dir / "mappings"
+        self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self.legacy_files = legacy_files or []
+        self._fp_day = None
+        self._fp = None
+
+    def segment_path(self, day: int) -> Path:
+        date_str = datetime.fromtimestamp(day * BUCKET_SECONDS, timezone.utc).strftime('%Y%m%d')
+        return self.segment_dir / f"mapping-{date_str}.log"
+
+    def segment_day(self, path: Path) -> int | None:
+        try:
+            date = datetime.strptime(path.stem.removeprefix("mapping-"), '%Y%m%d')
+        except ValueError:
+            return None
+        return int(date.replace(tzinfo=timezone.utc).timestamp()) // BUCKET_SECONDS
+
+    def list_segments(self) -> list:
+        """返回 [(day, path)]，按天升序"""
+        segments = []
+        for path in self.segment_dir.glob("mapping-*.log"):
+            day = self.segment_day(path)
+            if day is not None:
+                segments.append((day, path))
+        return sorted(segments)
+
+    def prepare(self):
+        if not self.list_segments():
+            self._migrate_legacy()
+
+    def load(self) -> list:
+        self.prepare()
+        entries = []
+        for _, path in self.list_segments():
+            entries.extend(self.load_segment(path))
+        return entries
+
+    def iter_load(self):
+        self.prepare()
+        for _, path in reversed(self.list_segments()):
+            yield self.load_segment(path)
+
+    def load_segment(self, path: Path) -> list:
+        entries = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # 崩溃时可能留下半行，跳过即可
+                    logging.warning(f"跳过损坏的映射记录 {path}:{line_no}")
+        return entries
+
+    def append(self, entries: list):
+        if not entries:
+            return
+        by_day = {}
+        for entry in entries:
+            by_day.setdefault(bucket_of(entry), []).append(entry)
+        for day, day_entries in by_day.items():
+            fp = self._open_segment(day)
+            fp.write("".join(self._dump(e) for e in day_entries))
+            fp.flush()
+
+    def rewrite(self, entries: list):
+        self.close()
+        by_day = {}
+        for entry in entries:
+            by_day.setdefault(bucket_of(entry), []).append(entry)
+        for day, path in self.list_segments():
+            if day not in by_day:
+                path.unlink()
+        for day, day_entries in by_day.items():
+            path = self.segment_path(day)
+            tmp_file = path.with_suffix('.log.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                for entry in day_entries:
+                    f.write(self._dump(entry))
+            os.replace(tmp_file, path)
+
+    def drop_buckets(self, days: list, remaining=None):
+        for day in days:
+            if day == self._fp_day:
+                self.close()
+            path = self.segment_path(day)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            self._fp_day = None
+
+    def _open_segment(self, day: int):
+        # 只保持当前写入段的句柄，跨天时切换
+        if self._fp_day != day:
+            self.close()
+            self._fp = open(self.segment_path(day), 'a', encoding='utf-8')
+            self._fp_day = day
+        return self._fp
+
+    def _dump(self, entry: dict) -> str:
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def _migrate_legacy(self):
+        """将旧版 message_mapping.json / message_mapping.log 一次性导入为分段日志"""
+        for legacy_file in self.legacy_files:
+            if not legacy_file.exists():
+                continue
+            try:
+                if legacy_file.suffix == '.json':
+                    with open(legacy_file, 'r', encoding='utf-8') as f:
+                        legacy = json.load(f)
+                    entries = []
+                    for value in legacy.values():
+                        entries.extend(value if isinstance(value, list) else [value])
+                else:
+                    entries = self.load_segment(legacy_file)
+            except Exception as e:
+                logging.error(f"读取旧版消息映射失败 {legacy_file}: {e}")
+                continue
+
+            for entry in entries:
+                if entry.get('ts') is None and entry.get('timestamp'):
+                    try:
+                        entry['ts'] = int(datetime.fromisoformat(entry['timestamp']).timestamp())
+                    except ValueError:
+                        pass
+            self.rewrite(entries)
+            # 迁移成功后移走旧文件，否则分段全部过期后下次启动会再次迁移，旧映射复活
+            if legacy_file.suffix == '.log':
+                legacy_file.unlink()
+            else:
+                os.replace(legacy_file, legacy_file.with_name(legacy_file.name + '.migrated'))
+            logging.info(f"已将 {len(entries)} 条旧版映射从 {legacy_file.name} 迁移到 {self.segment_dir}")
+            return
+
+
+class JsonMappingStore(MappingStore):
+    """旧版整文件 JSON 后端 (每次写入重写整个文件，仅用于兼容)"""
+
+    def __init__(self, data_dir: Path):
+        self.mapping_file = data_dir / "message_mapping.json"
+        self._entries = []
+
+    def load(self) -> list:
+        self._entries = []
+        if self.mapping_file.exists():
+            with open(self.mapping_file, 'r', encoding='utf-8') as f:
+                for value in json.load(f).values():
+                    self._entries.extend(value if isinstance(value, list) else [value])
+        return list(self._entries)
+
+    def append(self, entries: list):
+        self._entries.extend(entries)
+        self._save()
+
+    def rewrite(self, entries: list):
+        self._entries = list(entries)
+        self._save()
+
+    def _save(self):
+        mapping = {}
+        for entry in self._entries:
+            key = f"{entry.get('source_chat_id')}_{entry.get('source_msg_id')}"
+            mapping.setdefault(key, []).append(entry)
+        with open(self.mapping_file, 'w', encoding='utf-8') as f:
+            json.dump(mapping, f, ensure_ascii=False, indent=2)
+
+
+class BufferedMappingStore(MappingStore):
+    """写缓冲层 - 攒批后在独立线程中落盘 (按条数或时间触发)
+
+    进程崩溃时最多丢失 flush_interval 秒内的新映射。
+    """
+
+    def __init__(self, store: MappingStore, flush_interval: float = 1.0, batch_size: int = 200):
+        self.store = store
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.batch_size = max(1, int(batch_size))
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mapping-writer")
+
+    def prepare(self):
+        # 迁移会重写分段文件，放到写线程执行，与批量写入串行
+        self._executor.submit(self.store.prepare).result()
+
+    def load(self) -> list:
+        self.prepare()
+        return self.store.load()
+
+    def iter_load(self):
+        self.prepare()
+        return self.store.iter_load()
+
+    def append(self, entries: list):
+        if not entries:
+            return
+        with self._lock:
+            if self._closed:
+                logging.warning(f"映射存储已关闭，丢弃 {len(entries)} 条映射")
+                return
+            self._buffer.extend(entries)
+            if len(self._buffer) >= self.batch_size:
+                self._submit_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """立即提交缓冲区，返回写入任务的 Future (无数据时为 None)"""
+        with self._lock:
+            return self._submit_locked()
+
+    def rewrite(self, entries: list):
+        self.flush()
+        self._executor.submit(self.store.rewrite, list(entries)).result()
+
+    def drop_buckets(self, days: list, remaining):
+        self.flush()
+        # 剩余记录在调用线程取快照，实际删除/重写交给写线程，不阻塞事件循环
+        entries = None if self.store.supports_bucket_drop else remaining()
+        self._executor.submit(self.store.drop_buckets, list(days), lambda: entries)
+
+    def close(self):
+        future = self.flush()
+        with self._lock:
+            self._closed = True
+        if future is not None:
+            future.result()
+        self._executor.shutdown(wait=True)
+        self.store.close()
+
+    def _submit_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer or self._closed:
+            return None
+        batch, self._buffer = self._buffer, []
+        return self._executor.submit(self._write_batch, batch)
+
+    def _write_batch(self, batch: list):
+        try:
+            self.store.append(batch)
+        except Exception as e:
+            logging.error(f"批量保存消息映射失败 ({len(batch)} 条): {e}")
+
+
+def get_mapping_store(backend: str, data_dir: Path) -> MappingStore | None:
+    backend = str(backend or 'log').lower()
+
+    if backend in {'log', 'append_log', 'append-log'}:
+        return AppendLogMappingStore(
+            data_dir,
+            legacy_files=[data_dir / "message_mapping.log", data_dir / "message_mapping.json"],
+        )
+    if backend == 'json':
+        return JsonMappingStore(data_dir)
+
+    return None
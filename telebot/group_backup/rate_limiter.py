@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+
+from telethon.errors import FloodWaitError
+
+from .stats import LatencyHistogram
+
+# 数字越小优先级越高
+PRIORITY_NEW = 0
+PRIORITY_EDIT = 1
+PRIORITY_REACTION = 2
+PRIORITY_BULK = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_NEW: "new",
+    PRIORITY_EDIT: "edit",
+    PRIORITY_REACTION: "reaction",
+    PRIORITY_BULK: "bulk",
+}
+
+
+class TokenBucket:
+    """令牌桶: rate 个/秒，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(0.001, float(rate))
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """还需等待多久才有一个令牌"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class SendScheduler:
+    """所有对外 Telegram 调用的统一调度: 全局与单会话令牌桶、FloodWait 退避、按优先级放行
+
+    高优先级 (新消息) 仅因全局预算等待时，低优先级 (编辑/表情/批量) 的调用让路。
+    """
+
+    def __init__(self, global_rate: float = 20, global_burst: float = 20,
+                 chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max(0, int(max_retries))
+        self.logger = logging.getLogger(__name__)
+        self._chat_buckets = {}
+        self._paused_until = {} # chat_id -> monotonic deadline (FloodWait)
+        # 各优先级中只差全局令牌的等待者数量
+        self._global_waiters = {p: 0 for p in PRIORITY_NAMES}
+        self.throttle = {p: LatencyHistogram() for p in PRIORITY_NAMES}
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _higher_priority_waiting(self, priority: int) -> bool:
+        return any(count for p, count in self._global_waiters.items() if p < priority)
+
+    async def acquire(self, chat_id, priority: int = PRIORITY_NEW, cost: int = 1) -> float:
+        """等待发送许可，返回被限流的秒数; cost=0 只遵守 FloodWait 暂停 (用于读取)"""
+        start = time.monotonic()
+        chat_bucket = self._chat_bucket(chat_id)
+        waiting_global = False
+        try:
+            while True:
+                now = time.monotonic()
+                pause = self._paused_until.get(chat_id, 0) - now
+                chat_wait = chat_bucket.wait_time(now) if cost else 0.0
+                global_wait = self.global_bucket.wait_time(now) if cost else 0.0
+
+                blocked_on_global = pause <= 0 and chat_wait <= 0
+                if blocked_on_global != waiting_global:
+                    self._global_waiters[priority] += 1 if blocked_on_global else -1
+                    waiting_global = blocked_on_global
+
+                if max(pause, chat_wait, global_wait) <= 0 and not (cost and self._higher_priority_waiting(priority)):
+                    if cost:
+                        chat_bucket.consume()
+                        self.global_bucket.consume()
+                    break
+
+                delay = max(pause, chat_wait, global_wait)
+                # 让路给高优先级时短暂休眠后重试
+                await asyncio.sleep(delay if delay > 0 else 0.05)
+        finally:
+            if waiting_global:
+                self._global_waiters[priority] -= 1
+
+        throttled = time.monotonic() - start
+        self.throttle[priority].observe(throttled)
+        return throttled
+
+    async def call(self, chat_id, priority, func, *args, cost: int = 1, **kwargs):
+        """在调度下执行 func(*args, **kwargs)，遇到 FloodWait 暂停该会话后重新排队"""
+        attempt = 0
+        while True:
+            throttled = await self.acquire(chat_id, priority, cost)
+            if throttled > 1:
+                self.logger.debug(f"{PRIORITY_NAMES[priority]} call to {chat_id} throttled {throttled:.2f}s")
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                attempt += 1
+                self.flood_waits += 1
+                self.flood_wait_seconds += e.seconds
+                self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0), time.monotonic() + e.seconds)
+                self.logger.warning(
+                    f"FloodWait {e.seconds}s on {chat_id} ({PRIORITY_NAMES[priority]}), "
+                    f"attempt {attempt}/{self.max_retries}"
+                )
+                if attempt > self.max_retries:
+                    raise
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+            "paused_chats": {cid: round(until - now, 1) for cid, until in self._paused_until.items() if until > now},
+            "throttle": {PRIORITY_NAMES[p]: h.snapshot() for p, h in self.throttle.items() if h.count},
+        }
@@ -0,0 +1,56 @@
+import pytz
+
+HEADER_SEPARATOR = "─" * 30 + "\n"
+
+
+def parse_focus_users(raw_list) -> set:
+    """用户 ID 保持 int，用户名去掉 @ 并转小写"""
+    parsed = set()
+    for u in raw_list or []:
+        if isinstance(u, int):
+            parsed.add(u)
+        elif isinstance(u, str):
+            parsed.add(u.lstrip('@').lower())
+    return parsed
+
+
+def resolve_timezone(timezone_str):
+    try:
+        return pytz.timezone(timezone_str)
+    except Exception:
+        return pytz.utc
+
+
+class TargetRenderer:
+    """单个 (源, 目标) 配置预编译后的头部渲染器: 合并后的关注用户集合与预渲染的名称/标签行"""
+
+    __slots__ = ('focus_users', 'target_line')
+
+    def __init__(self, target_info, global_focus_users=frozenset()):
+        focus = set(global_focus_users)
+        focus.update(parse_focus_users(target_info.get('source_focus_users')))
+        focus.update(parse_focus_users(target_info.get('target_focus_users')))
+        self.focus_users = frozenset(focus)
+
+        target_line = ""
+        if target_info.get('name'):
+            target_line += f"\n📢 {target_info['name']}"
+        if target_info.get('tag'):
+            target_line += f" {target_info['tag']}"
+        self.target_line = target_line
+
+    def is_focused(self, ctx) -> bool:
+        if not ctx.sender:
+            return False
+        return ctx.sender_id in self.focus_users or (
+            ctx.sender_username_lower is not None and ctx.sender_username_lower in self.focus_users
+        )
+
+    def render_header(self, ctx, separator: bool = True) -> str:
+        sender_name = ctx.sender_name
+        if self.is_focused(ctx):
+            sender_name = f"**{sender_name}**"
+        # 头像图标取 (可能已加粗的) 名称首字符，与历史输出保持一致
+        avatar_icon = f"🧑[{sender_name[0]}]" if sender_name else "🧑"
+        header = f"{avatar_icon} {sender_name} {ctx.sender_username}{self.target_line}{ctx.header_tail}"
+        return header + HEADER_SEPARATOR if separator else header
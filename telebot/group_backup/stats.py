@@ -0,0 +1,29 @@
+import bisect
+
+
+class LatencyHistogram:
+    """固定分桶的延迟直方图 (秒)"""
+
+    DEFAULT_BOUNDS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self) -> dict:
+        labels = [f"<={b}s" for b in self.bounds] + [f">{self.bounds[-1]}s"]
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "max": round(self.max, 3),
+            "buckets": dict(zip(labels, self.counts)),
+        }
@@ -1,3 +1,5 @@
+import asyncio
+import itertools
 import logging
 import json
 from pathlib import Path
@@ -6,16 +8,36 @@ from datetime import datetime
 import pytz
 
 from telebot.ai_sdk import get_ai_provider
+from telebot.ai_sdk.prompts import DEFAULT_SUMMARY_PROMPT
+
+from .entity_cache import EntityCache
+from .export import meta_path_for, open_export
+from .summary_cache import SummaryCache
+from .summary_input import SUMMARY_TEXT_LIMIT, group_export_by_source, iter_context_chunks
+from .rate_limiter import SendScheduler, PRIORITY_BULK
 
 TELEGRAM_MESSAGE_LIMIT = 4096
 TELEGRAM_SAFE_MESSAGE_LIMIT = 3800
 
+REDUCE_SUMMARY_PROMPT = (
+    "你会收到同一个 Telegram 群组同一天聊天记录按时间顺序切分后的若干分段总结。"
+    "请把它们合并成一份完整的每日总结。\n"
+    "要求：\n"
+    "1. 合并重复或跨分段延续的主题，按时间顺序组织。\n"
+    "2. 保持分段总结的格式 (### 主题标题 ([Link to start](SourceLink)) 加要点列表)，"
+    "每个主题保留其最早的 SourceLink。\n"
+    "3. 保留重点关注用户 (Followed User) 的发言并明确提及其名字。\n"
+    "4. 不要提及分段或合并过程。"
+)
+
 class GroupSummarizer:
-    def __init__(self, client, config, mapper, logger=None):
+    def __init__(self, client, config, mapper, logger=None, entity_cache=None, scheduler=None):
         self.client = client
         self.config = config
         self.mapper = mapper
         self.logger = logger or logging.getLogger(__name__)
+        self.entity_cache = entity_cache or EntityCache(client)
+        self.scheduler = scheduler or SendScheduler()
         
         self.summary_config = config.get('summary', {})
         self.enabled = self.summary_config.get('enabled', False)
@@ -31,6 +53,11 @@ class GroupSummarizer:
         self.state_loaded_at = self._get_state_mtime()
         self.processed_files = self._load_state()
         self.focus_users = self._parse_focus_users()
+        # 所有来源/分块共用的 AI 调用并发上限
+        self.provider_semaphore = asyncio.Semaphore(max(1, int(self.summary_config.get('max_concurrency', 2))))
+        # 相同输入的 AI 结果缓存 (重试/重新处理时不再调用模型)
+        cache_max_bytes = self.summary_config.get('cache_max_bytes', 50 * 1024 * 1024)
+        self.cache = SummaryCache(self.data_dir / "summary_cache", cache_max_bytes) if self.enabled and cache_max_bytes else None
 
     def _parse_focus_users(self):
         raw = self.config.get('settings', {}).get('focus_users', [])
@@ -67,59 +94,92 @@ class GroupSummarizer:
             return
 
         self.logger.info(f"Generating summary for {file_key}...")
+        await self.mapper.wait_until_loaded()
         
-        messages = []
+        # Stream the file once, grouping by source
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    if line.strip():
-                        messages.append(json.loads(line))
+            source_groups = group_export_by_source(file_path, target_id, self.mapper)
         except Exception as e:
             self.logger.error(f"Failed to read backup file {file_path}: {e}")
             return
 
-        if not messages:
-            return
-
-        # Group by Source
-        source_groups = {} # source_id -> [msgs]
-        
-        for msg in messages:
-            t_msg_id = msg.get('id')
-            source_info = self.mapper.get_source_info(target_id, t_msg_id)
-            
-            source_id = None
-            if source_info:
-                source_id = source_info.get('source_chat_id')
-                msg['_source_msg_id'] = source_info.get('source_msg_id')
-            
-            if not source_id:
-                continue
-
-            if source_id not in source_groups:
-                source_groups[source_id] = []
-            source_groups[source_id].append(msg)
-
-        if not source_groups:
-            self.logger.warning(f"No mapped source messages found for summary file {file_key}")
-            self.processed_files.add(file_key)
-            self._save_state()
-            return
+        # 各源群的消息暂存在临时文件中，处理结束 (含超时/异常) 后删除
+        with source_groups:
+            if not source_groups:
+                self.logger.warning(f"No mapped source messages found for summary file {file_key}")
+                self.processed_files.add(file_key)
+                self._save_state()
+                return
+
+            # Process sources concurrently; sources already sent in an earlier attempt are skipped
+            pending_sources = {
+                source_id: items for source_id, items in source_groups.items()
+                if self._source_key(processed_key, source_id) not in self.processed_files
+            }
+            tasks = {
+                asyncio.create_task(self._summarize_source_tracked(source_id, items, file_key, processed_key)): source_id
+                for source_id, items in pending_sources.items()
+            }
+            deadline = self.summary_config.get('deadline_seconds', 1800)
+            done, not_done = await asyncio.wait(tasks, timeout=deadline) if tasks else (set(), set())
+            for task in not_done:
+                task.cancel()
+            if not_done:
+                # 等取消完成再删除临时文件
+                await asyncio.gather(*not_done, return_exceptions=True)
+                self.logger.error(
+                    f"Summary of {file_key} hit the {deadline}s deadline; unfinished sources: "
+                    f"{sorted(tasks[t] for t in not_done)}"
+                )
+            all_sent = not not_done and all(task.result() for task in done)
+
+            # Mark as done only after all summaries were sent successfully.
+            if all_sent:
+                for source_id in source_groups:
+                    self.processed_files.discard(self._source_key(processed_key, source_id))
+                self.processed_files.add(processed_key)
+                self._save_state()
+            else:
+                self.logger.warning(f"Summary file {file_key} was not marked processed because sending failed")
 
-        # Process each Source
-        all_sent = True
-        for source_id, msgs in source_groups.items():
-            if not await self._summarize_source(source_id, msgs, file_key):
-                all_sent = False
+    def _source_key(self, processed_key, source_id) -> str:
+        return f"{processed_key}#{source_id}"
 
-        # Mark as done only after all summaries were sent successfully.
-        if all_sent:
-            self.processed_files.add(processed_key)
+    async def _summarize_source_tracked(self, source_id, items, file_key, processed_key) -> bool:
+        """总结单个来源并记录成功，重试整个文件时不会重复发送已成功的来源"""
+        try:
+            sent = await self._summarize_source(source_id, items, file_key)
+        except Exception as e:
+            self.logger.error(f"Summary of source {source_id} in {file_key} failed: {e}", exc_info=True)
+            return False
+        if sent:
+            self.processed_files.add(self._source_key(processed_key, source_id))
             self._save_state()
-        else:
-            self.logger.warning(f"Summary file {file_key} was not marked processed because sending failed")
-
-    async def _summarize_source(self, source_id, msgs, file_key):
+        return sent
+
+    async def _call_provider(self, content: str, prompt: str | None) -> str:
+        key = None
+        if self.cache:
+            key = SummaryCache.make_key(
+                self.summary_config.get('provider', 'openai'),
+                self.summary_config.get('model', ''),
+                prompt or DEFAULT_SUMMARY_PROMPT,
+                content,
+            )
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.logger.info("Using cached summary result")
+                return cached
+
+        async with self.provider_semaphore:
+            result = await self.provider.generate_summary(content, prompt)
+        # 只缓存成功的结果
+        if key and result and not self._is_provider_error(result):
+            self.cache.put(key, result)
+        return result
+
+    async def _summarize_source(self, source_id, items, file_key):
+        """items: SourceGroup，逐条产出 (source_msg_id, sender_id, text)，见 group_export_by_source"""
         # Find Source Config
         source_conf = self.config.get('groups', {}).get(source_id)
         if not source_conf:
@@ -161,9 +221,6 @@ class GroupSummarizer:
         if not target_chat_id:
             return False
 
-        # Prepare Content for AI
-        formatted_lines = []
-        
         # Load focus users from config
         focus_users = set()
         raw_focus = self.summary_config.get('focus_users', [])
@@ -171,16 +228,12 @@ class GroupSummarizer:
             focus_users.add(str(u))
             
         # Resolve Sender Names dynamically (to avoid polluting backup files)
-        sender_ids = set()
-        for m in msgs:
-            sid = m.get('sender_id')
-            if sid: sender_ids.add(int(sid))
+        sender_ids = items.sender_ids
             
         sender_map = {}
         if sender_ids and self.client:
             try:
-                users = await self.client.get_entity(list(sender_ids))
-                if not isinstance(users, list): users = [users]
+                users = await self.entity_cache.get_entities(list(sender_ids))
                 
                 for u in users:
                     name = getattr(u, 'first_name', '') or ''
@@ -190,42 +243,14 @@ class GroupSummarizer:
             except Exception as e:
                 self.logger.warning(f"Failed to resolve sender names for summary: {e}")
 
-        for m in msgs:
-            clean_source_id = str(source_id)
-            if clean_source_id.startswith("-100"):
-                clean_source_id = clean_source_id[4:]
-            
-            real_src_id = m.get('_source_msg_id', m['id'])
-            link = f"https://t.me/c/{clean_source_id}/{real_src_id}"
-            
-            text_content = m.get('text', '')
-            
-            sender_id = m.get('sender_id')
-            if sender_id in current_focus_set:
-                text_content = f"【重点关注用户发言】 {text_content}"
-            
-            if len(text_content) > 500:
-                text_content = text_content[:500] + "..."
-            
-            # Check for followed user
-            sender_id_raw = m.get('sender_id')
-            sender_id = str(sender_id_raw) if sender_id_raw else ''
-            
-            sender_name = sender_map.get(sender_id_raw, 'Unknown') if sender_id_raw else 'Unknown'
-            
-            is_followed = sender_id in focus_users
-            
-            msg_header = f"Msg: {text_content}"
-            if is_followed:
-                msg_header = f"Msg (Followed User {sender_name}): {text_content}"
-            elif sender_name and sender_name != 'Unknown':
-                 msg_header = f"Msg ({sender_name}): {text_content}"
-                
-            formatted_lines.append(f"{msg_header}\nSourceLink: {link}\n---")
-
-        context_text = "\n".join(formatted_lines)
-        if not context_text.strip():
+        # Prepare Content for AI, packed into chunks under the char budget
+        lines = self._iter_summary_lines(source_id, items, sender_map, current_focus_set, focus_users)
+        # 逐块生成，不一次性构造全部上下文
+        chunks = iter_context_chunks(lines, self.summary_config.get('chunk_chars', 60000))
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
             return True
+        chunks = itertools.chain((first_chunk,), chunks)
 
         # Prompt
         group_tag = source_conf.get('tag', '')
@@ -243,7 +268,7 @@ class GroupSummarizer:
             )
             custom_prompt += emphasis
         
-        summary_content = await self.provider.generate_summary(context_text, custom_prompt)
+        summary_content = await self._generate_chunked_summary(chunks, custom_prompt)
         if self._is_provider_error(summary_content):
             self.logger.error(f"Failed to generate summary for {source_id}: {summary_content}")
             return False
@@ -262,6 +287,36 @@ class GroupSummarizer:
             summary_content=summary_content,
         )
 
+    def _iter_summary_lines(self, source_id, items, sender_map, current_focus_set, focus_users):
+        """逐条生成送入 AI 的消息行"""
+        clean_source_id = str(source_id)
+        if clean_source_id.startswith("-100"):
+            clean_source_id = clean_source_id[4:]
+
+        for real_src_id, sender_id_raw, text_content in items:
+            link = f"https://t.me/c/{clean_source_id}/{real_src_id}"
+            
+            if sender_id_raw in current_focus_set:
+                text_content = f"【重点关注用户发言】 {text_content}"
+            
+            if len(text_content) > SUMMARY_TEXT_LIMIT:
+                text_content = text_content[:SUMMARY_TEXT_LIMIT] + "..."
+            
+            # Check for followed user
+            sender_id = str(sender_id_raw) if sender_id_raw else ''
+            
+            sender_name = sender_map.get(sender_id_raw, 'Unknown') if sender_id_raw else 'Unknown'
+            
+            is_followed = sender_id in focus_users
+            
+            msg_header = f"Msg: {text_content}"
+            if is_followed:
+                msg_header = f"Msg (Followed User {sender_name}): {text_content}"
+            elif sender_name and sender_name != 'Unknown':
+                 msg_header = f"Msg ({sender_name}): {text_content}"
+                
+            yield f"{msg_header}\nSourceLink: {link}\n---"
+
     async def _send_summary(
         self,
         target_chat_id: int,
@@ -351,7 +406,8 @@ class GroupSummarizer:
                 condensed_msg,
                 reply_to=target_topic_id,
             )
-            await self.client.send_file(
+            await self.scheduler.call(
+                target_chat_id, PRIORITY_BULK, self.client.send_file,
                 target_chat_id,
                 str(md_path),
                 caption=f"#总结 {group_tag} #date_{date_str}\n完整 Markdown 总结",
@@ -371,7 +427,8 @@ class GroupSummarizer:
     ) -> None:
         """Send message text with Telegram Markdown rendering, falling back to plain text."""
         try:
-            await self.client.send_message(
+            await self.scheduler.call(
+                target_chat_id, PRIORITY_BULK, self.client.send_message,
                 target_chat_id,
                 message,
                 reply_to=reply_to,
@@ -383,13 +440,65 @@ class GroupSummarizer:
                 raise
 
             self.logger.warning(f"Markdown parse failed; sending plain text instead: {e}")
-            await self.client.send_message(
+            await self.scheduler.call(
+                target_chat_id, PRIORITY_BULK, self.client.send_message,
                 target_chat_id,
                 message,
                 reply_to=reply_to,
                 link_preview=False,
             )
 
+    async def _map_chunks(self, chunks, prompt: str | None) -> list:
+        """按顺序总结各块，边生成边提交，同时在内存中的块不超过 map_concurrency 个"""
+        limit = max(1, int(self.summary_config.get('map_concurrency', 4)))
+        tasks = []
+        running = set()
+        try:
+            for chunk in chunks:
+                if len(running) >= limit:
+                    _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                task = asyncio.create_task(self._call_provider(chunk, prompt))
+                tasks.append(task)
+                running.add(task)
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _generate_chunked_summary(self, chunks, prompt: str | None) -> str:
+        """单块直接总结；多块时并发总结各块 (map)，再逐层合并分段总结 (reduce)
+
+        chunks 可以是惰性迭代器，只在提交时生成。
+        """
+        chunks = iter(chunks)
+        first = next(chunks)
+        second = next(chunks, None)
+        if second is None:
+            return await self._call_provider(first, prompt)
+        chunks = itertools.chain((first, second), chunks)
+
+        budget = self.summary_config.get('chunk_chars', 60000)
+
+        level = 0
+        while True:
+            partials = await self._map_chunks(chunks, prompt)
+            self.logger.info(f"Summarized {len(partials)} chunks (level {level})")
+            for partial in partials:
+                if self._is_provider_error(partial):
+                    return partial
+            if len(partials) == 1:
+                return partials[0]
+
+            sections = [f"Part {i}/{len(partials)}:\n{partial}" for i, partial in enumerate(partials, 1)]
+            reduced = list(iter_context_chunks(sections, budget))
+            if len(reduced) >= len(partials):
+                # 分段总结本身仍超出预算时不再拆分，避免无法收敛
+                reduced = ["\n".join(sections)]
+            chunks = reduced
+            prompt = REDUCE_SUMMARY_PROMPT
+            level += 1
+
     async def _generate_condensed_summary(self, summary_content: str) -> str:
         prompt = (
             "你会收到一份已经生成的 Telegram 群组每日总结。请把它再次压缩成适合 Telegram "
@@ -401,7 +510,7 @@ class GroupSummarizer:
             "4. 控制在 2500 个中文字符以内。\n"
             "5. 不要提及你在压缩总结。"
         )
-        return await self.provider.generate_summary(summary_content, prompt)
+        return await self._call_provider(summary_content, prompt)
 
     def _write_markdown_summary(
         self,
@@ -413,7 +522,7 @@ class GroupSummarizer:
     ) -> Path:
         self.summary_dir.mkdir(parents=True, exist_ok=True)
         safe_source_id = self._safe_filename(str(source_id))
-        safe_file_key = self._safe_filename(file_key.removesuffix(".bak"))
+        safe_file_key = self._safe_filename(file_key.removesuffix(".gz").removesuffix(".bak"))
         md_path = self.summary_dir / f"{safe_file_key}_{safe_source_id}_summary.md"
 
         with open(md_path, 'w', encoding='utf-8') as f:
@@ -495,14 +604,15 @@ class GroupSummarizer:
             
         self.logger.info("Starting summary scan...")
         # Get all daily files
-        for file_path in self.data_dir.glob("*_daily.bak"):
+        daily_files = list(self.data_dir.glob("*_daily.bak")) + list(self.data_dir.glob("*_daily.bak.gz"))
+        for file_path in daily_files:
              file_key = file_path.name
              processed_key = self._get_processed_key(file_path)
              if self._is_already_processed(file_path, file_key, processed_key):
                  continue
 
              # Look for metadata file
-             meta_path = file_path.with_suffix('.bak.meta')
+             meta_path = meta_path_for(file_path)
              target_id = None
              
              if meta_path.exists():
@@ -524,7 +634,7 @@ class GroupSummarizer:
     def _infer_target_id(self, file_path):
         try:
             messages_to_check = []
-            with open(file_path, 'r') as f:
+            with open_export(file_path) as f:
                 for _ in range(5):
                     line = f.readline()
                     if line:
@@ -535,9 +645,8 @@ class GroupSummarizer:
             candidates = {}
             for msg in messages_to_check:
                 mid = msg['id']
-                for (tid, r_mid) in self.mapper.reverse_mapping.keys():
-                    if r_mid == mid:
-                        candidates[tid] = candidates.get(tid, 0) + 1
+                for tid in self.mapper.find_backup_chats(mid):
+                    candidates[tid] = candidates.get(tid, 0) + 1
             
             if candidates:
                 best_tid = max(candidates, key=candidates.get)
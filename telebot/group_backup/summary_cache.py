@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+
+class SummaryCache:
+    """按内容寻址的 AI 总结缓存: sha256(provider, model, prompt, content) -> 结果文本
+
+    重试发送或重新处理同一文件时直接复用结果；总大小超过 max_bytes 时淘汰最久未用的条目。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 50 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max(0, int(max_bytes))
+        self.logger = logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.total_bytes = sum(p.stat().st_size for p in self.cache_dir.glob("*.txt"))
+
+    @staticmethod
+    def make_key(provider: str, model: str, prompt: str | None, content: str) -> str:
+        h = hashlib.sha256()
+        for part in (provider, model, prompt, content):
+            data = (part or "").encode('utf-8')
+            # 长度前缀避免不同字段拼接后碰撞
+            h.update(len(data).to_bytes(8, 'big'))
+            h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.txt"
+
+    def get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            text = path.read_text(encoding='utf-8')
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path) # mtime 作为最近使用时间
+        except OSError:
+            pass
+        self.hits += 1
+        return text
+
+    def put(self, key: str, text: str):
+        if not self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            previous = path.stat().st_size if path.exists() else 0
+            tmp_path.write_text(text, encoding='utf-8')
+            os.replace(tmp_path, path)
+            self.total_bytes += path.stat().st_size - previous
+        except OSError as e:
+            self.logger.warning(f"Failed to write summary cache entry: {e}")
+            return
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.cache_dir.glob("*.txt"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+    def stats(self) -> dict:
+        return {"bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
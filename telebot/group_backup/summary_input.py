@@ -0,0 +1,102 @@
+import json
+import tempfile
+from pathlib import Path
+
+from .export import iter_export_records
+
+# 单条消息送入总结的最大字符数 (超出部分截断并加 "...")
+SUMMARY_TEXT_LIMIT = 500
+
+
+class SourceGroup:
+    """单个源群的总结输入，暂存在临时文件中，迭代时逐条读出 (source_msg_id, sender_id, text)"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.count = 0
+        self.sender_ids = set()
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def add(self, source_msg_id, sender_id, text):
+        self._file.write(json.dumps([source_msg_id, sender_id, text], ensure_ascii=False) + '\n')
+        self.count += 1
+        if sender_id:
+            self.sender_ids.add(int(sender_id))
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield tuple(json.loads(line))
+
+
+class SourceGroups(dict):
+    """{source_id: SourceGroup}，临时文件在退出 with 块时删除"""
+
+    def __init__(self):
+        super().__init__()
+        self._dir = tempfile.TemporaryDirectory(prefix="summary-")
+
+    def group(self, source_id) -> SourceGroup:
+        group = self.get(source_id)
+        if group is None:
+            group = self[source_id] = SourceGroup(Path(self._dir.name) / f"{len(self)}.jsonl")
+        return group
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for group in self.values():
+            group.close()
+        self._dir.cleanup()
+
+
+def group_export_by_source(file_path, target_id, mapper) -> SourceGroups:
+    """一次遍历导出文件，按源群分组写入临时文件 (调用方用 with 管理其生命周期)
+
+    只保留总结需要的字段，文本预先截断 (多留 1 个字符用于判断是否需要 "...")。
+    内存中只保留每个源群的发送者 ID 集合，与消息条数无关。
+    """
+    groups = SourceGroups()
+    try:
+        for record in iter_export_records(file_path):
+            source_info = mapper.get_source_info(target_id, record.get('id'))
+            if not source_info:
+                continue
+            source_id = source_info.get('source_chat_id')
+            if not source_id:
+                continue
+            text = (record.get('text') or '')[:SUMMARY_TEXT_LIMIT + 1]
+            groups.group(source_id).add(source_info.get('source_msg_id'), record.get('sender_id'), text)
+    except BaseException:
+        groups.__exit__(None, None, None)
+        raise
+    for group in groups.values():
+        group.close()
+    return groups
+
+
+def iter_context_chunks(lines, budget: int):
+    """将格式化后的行按字符预算打包成若干上下文块 (行之间以换行连接)
+
+    单行超过预算时独占一块，不会被拆开。
+    """
+    chunk = []
+    size = 0
+    for line in lines:
+        extra = len(line) + (1 if chunk else 0)
+        if chunk and size + extra > budget:
+            yield "\n".join(chunk)
+            chunk = []
+            size = 0
+            extra = len(line)
+        chunk.append(line)
+        size += extra
+    if chunk:
+        yield "\n".join(chunk)
@@ -0,0 +1,91 @@
+from telethon.tl import types
+
+from .mapper import MappingRecord
+
+
+def encode_task(task_type: str, args: tuple) -> dict:
+    """将队列任务 (task_type, args) 转为可 JSON 序列化的 dict
+
+    只保存消息的 (chat_id, msg_id) 引用，还原时重新从 Telegram 拉取消息。
+    """
+    if task_type == 'new':
+        message, target_id, target_info = args
+        return {'type': task_type, 'chat_id': message.chat_id, 'msg_ids': [message.id],
+                'target_id': target_id, 'target_info': target_info}
+    if task_type == 'album':
+        messages, target_id, target_info = args
+        return {'type': task_type, 'chat_id': messages[0].chat_id, 'msg_ids': [m.id for m in messages],
+                'target_id': target_id, 'target_info': target_info}
+    if task_type == 'edit':
+        msg, target_id, backup = args
+        return {'type': task_type, 'chat_id': msg.chat_id, 'msg_ids': [msg.id],
+                'target_id': target_id, 'backup': _encode_backup(backup)}
+    if task_type == 'delete':
+        msg_ids, chat_id, target_id, backup = args
+        return {'type': task_type, 'chat_id': chat_id, 'msg_ids': list(msg_ids),
+                'target_id': target_id, 'backup': _encode_backup(backup)}
+    if task_type == 'delete_batch':
+        msg_ids, chat_id, target_id, backups = args
+        return {'type': task_type, 'chat_id': chat_id, 'msg_ids': list(msg_ids),
+                'target_id': target_id, 'backups': [_encode_backup(b) for b in backups]}
+    if task_type == 'reaction':
+        event, target_id, backup = args
+        reaction = getattr(event, 'reaction', None)
+        return {'type': task_type, 'chat_id': event.chat_id, 'msg_ids': [event.msg_id],
+                'target_id': target_id, 'backup': _encode_backup(backup),
+                'reaction': reaction.to_dict() if reaction is not None else None}
+    raise ValueError(f"Unknown task type: {task_type}")
+
+
+async def decode_task(client, data: dict):
+    """还原队列任务；源消息已不存在时返回 None"""
+    task_type = data['type']
+    chat_id = data['chat_id']
+    msg_ids = data['msg_ids']
+    target_id = data['target_id']
+
+    if task_type == 'delete':
+        return task_type, (msg_ids, chat_id, target_id, MappingRecord.from_dict(data['backup']))
+    if task_type == 'delete_batch':
+        return task_type, (msg_ids, chat_id, target_id, [MappingRecord.from_dict(b) for b in data['backups']])
+    if task_type == 'reaction':
+        event = ReplayedReactionEvent(msg_ids[0], chat_id, _decode_reaction(data.get('reaction')))
+        return task_type, (event, target_id, MappingRecord.from_dict(data['backup']))
+
+    messages = await client.get_messages(chat_id, ids=msg_ids)
+    if not isinstance(messages, list):
+        messages = [messages]
+    messages = [m for m in messages if m is not None]
+    if not messages:
+        return None
+
+    if task_type == 'new':
+        return task_type, (messages[0], target_id, data['target_info'])
+    if task_type == 'album':
+        return task_type, (messages, target_id, data['target_info'])
+    if task_type == 'edit':
+        return task_type, (messages[0], target_id, MappingRecord.from_dict(data['backup']))
+    raise ValueError(f"Unknown task type: {task_type}")
+
+
+class ReplayedReactionEvent:
+    """重放的表情反应事件 (与 core 中构造的事件字段一致)"""
+
+    def __init__(self, msg_id, chat_id, reaction):
+        self.msg_id = msg_id
+        self.chat_id = chat_id
+        self.reaction = reaction
+
+
+def _encode_backup(backup) -> dict:
+    return backup.to_dict() if isinstance(backup, MappingRecord) else dict(backup)
+
+
+def _decode_reaction(data):
+    if not data:
+        return None
+    fields = dict(data)
+    cls = getattr(types, fields.pop('_', ''), None)
+    if cls is None:
+        return None
+    return cls(**fields)